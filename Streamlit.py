@@ -1,53 +1,470 @@
+import time
+DEBUT_EXECUTION = time.perf_counter()
+
 import streamlit as st
-import gspread
-from google.oauth2.service_account import Credentials
 from datetime import datetime
+from contextlib import closing, contextmanager
+from collections import deque
+import hashlib
+import json
+import os
+import tempfile
 import uuid
+import importlib.util
+import itertools
+import logging
+import re
+import sqlite3
+import numpy as np
+import threading
+import heapq
+# gspread, google-auth, sib_api_v3_sdk, supabase, pandas et altair sont importés
+# à la première utilisation (voir client_supabase, ouvrir_classeur, api_brevo, mode admin)
+
 # ======================
-# BREVO SDK
+# JOURNAUX DU SERVEUR (LOGS DU CONTENEUR)
 # ======================
-from sib_api_v3_sdk import Configuration, ApiClient
-from sib_api_v3_sdk.api.transactional_emails_api import TransactionalEmailsApi
-from sib_api_v3_sdk.models import SendSmtpEmail
+LOGGER = logging.getLogger("indisponibilites")
+if not LOGGER.handlers:
+    # configuré une seule fois par processus (le script est réexécuté à chaque interaction)
+    _sortie_logs = logging.StreamHandler()
+    _sortie_logs.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    LOGGER.addHandler(_sortie_logs)
+    LOGGER.setLevel(logging.INFO)
+    LOGGER.propagate = False
 
 # ======================
-# SUPABASE
+# TEMPS DE DÉMARRAGE
 # ======================
+@st.cache_resource
+def rapport_demarrage():
+    return {"debut": datetime.now(), "etapes": {}, "executions": deque(maxlen=50)}
+
+@contextmanager
+def chronometrer(etape):
+    # Seule la première mesure d'une étape est celle du démarrage ; les suivantes
+    # (ex. rafraîchissement du cache de référence) ne sont journalisées qu'en DEBUG
+    debut = time.perf_counter()
+    try:
+        yield
+    finally:
+        duree = (time.perf_counter() - debut) * 1000
+        etapes = rapport_demarrage()["etapes"]
+        if etape in etapes:
+            LOGGER.debug("[exécution] %s : %.0f ms", etape, duree)
+        else:
+            etapes[etape] = duree
+            LOGGER.info("[démarrage] %s : %.0f ms", etape, duree)
+
+# ======================
+# INSTRUMENTATION DES APPELS (SUPABASE, SHEETS, BREVO)
+# ======================
+MAX_APPELS_JOURNAL = 20000
+
+@st.cache_resource
+def journal_appels():
+    # Partagé par toutes les sessions ; activable en mode admin ou par INSTRUMENTATION = true
+    return {"actif": bool(st.secrets.get("INSTRUMENTATION", False)), "appels": deque(maxlen=MAX_APPELS_JOURNAL)}
 
-from supabase import create_client
+if "_id_session" not in st.session_state:
+    st.session_state._id_session = uuid.uuid4().hex[:8]
+st.session_state._numero_execution = st.session_state.get("_numero_execution", 0) + 1
+CONTEXTE_EXECUTION = (st.session_state._id_session, st.session_state._numero_execution)
+CONTEXTE_BOITE_ENVOI = ("boite-envoi", None)
+CONTEXTE_JOURNAL = ("journal-sauvegardes", None)
 
-SUPABASE_URL = st.secrets["SUPABASE_URL"]
-SUPABASE_KEY = st.secrets["SUPABASE_KEY"]
+def taille_json(valeur):
+    try:
+        return len(json.dumps(valeur, default=str))
+    except Exception:
+        return 0
+
+def appel_instrumente(journal, contexte, service, operation, fonction, taille=taille_json):
+    # Désactivé : un simple test de booléen avant l'appel
+    if not journal["actif"]:
+        return fonction()
+    debut = time.perf_counter()
+    resultat, statut = None, "ok"
+    try:
+        resultat = fonction()
+        return resultat
+    except Exception:
+        statut = "erreur"
+        raise
+    finally:
+        journal["appels"].append({
+            "horodatage": datetime.now().isoformat(timespec="milliseconds"),
+            "session": contexte[0],
+            "execution": contexte[1],
+            "service": service,
+            "operation": operation,
+            "duree_ms": round((time.perf_counter() - debut) * 1000, 2),
+            "octets": taille(resultat) if resultat is not None else 0,
+            "statut": statut
+        })
+
+class RequeteInstrumentee:
+    # Enveloppe une requête postgrest : seul .execute() est mesuré
+    OPERATIONS = ("select", "insert", "upsert", "update", "delete")
+
+    def __init__(self, requete, operation, journal, contexte):
+        self._requete = requete
+        self._operation = operation
+        self._journal = journal
+        self._contexte = contexte
+
+    def execute(self):
+        return appel_instrumente(
+            self._journal, self._contexte, "supabase", self._operation,
+            self._requete.execute, taille=lambda r: taille_json(r.data)
+        )
+
+    def __getattr__(self, nom):
+        attribut = getattr(self._requete, nom)
+        if not callable(attribut):
+            return attribut
+
+        def chainer(*args, **kwargs):
+            resultat = attribut(*args, **kwargs)
+            if not hasattr(resultat, "execute"):
+                return resultat
+            operation = self._operation
+            if nom in self.OPERATIONS:
+                operation = f"{operation.split('.')[0]}.{nom}"
+            return RequeteInstrumentee(resultat, operation, self._journal, self._contexte)
+        return chainer
 
-supabase = create_client(SUPABASE_URL, SUPABASE_KEY)
+class SupabaseInstrumente:
+    def __init__(self, client, journal, contexte):
+        self._client = client
+        self._journal = journal
+        self._contexte = contexte
+
+    def table(self, nom):
+        return RequeteInstrumentee(self._client.table(nom), f"{nom}.select", self._journal, self._contexte)
+
+    def rpc(self, nom, parametres=None):
+        return RequeteInstrumentee(self._client.rpc(nom, parametres), f"rpc.{nom}", self._journal, self._contexte)
+
+def instrumenter_supabase(client, journal, contexte):
+    return SupabaseInstrumente(client, journal, contexte) if journal["actif"] else client
+
+# ======================
+# SERVICES LOCAUX (BENCHMARK / HORS LIGNE)
+# ======================
+def services_locaux():
+    # SERVICES_LOCAUX = true dans secrets.toml : doublures en mémoire (bench/faux_services.py)
+    return bool(st.secrets.get("SERVICES_LOCAUX", False))
+
+# ======================
+# SUPABASE
+# ======================
+@st.cache_resource
+def client_supabase_brut():
+    # Client unique (et pool HTTP unique) pour toutes les sessions
+    if services_locaux():
+        from bench.faux_services import ClientSupabase
+        return ClientSupabase()
+    with chronometrer("import supabase"):
+        from supabase import create_client
+    with chronometrer("client Supabase"):
+        return create_client(st.secrets["SUPABASE_URL"], st.secrets["SUPABASE_KEY"])
+
+@st.cache_resource
+def client_schema(schema):
+    # Un client par schéma (département), tous sur le pool HTTP du client unique
+    client = client_supabase_brut()
+    if schema == "public":
+        return client
+    if services_locaux():
+        return client.schema(schema)
+    from postgrest import SyncPostgrestClient
+    base = client.postgrest
+    return SyncPostgrestClient(str(base.base_url), schema=schema, headers=dict(base.headers), http_client=base.session)
+
+def client_supabase():
+    return instrumenter_supabase(client_schema(DEPARTEMENT["schema"]), journal_appels(), CONTEXTE_EXECUTION)
+
+def erreur_fonction_absente(e):
+    # PGRST202 = fonction RPC introuvable (ou ancienne signature) ; 42703 = colonne
+    # inconnue dans la fonction installée (version antérieure au schéma en place) :
+    # dans les deux cas, repli sur les requêtes de l'application
+    return getattr(e, "code", None) in ("PGRST202", "42703")
+
+def erreur_table_absente(e):
+    # PGRST205 = table introuvable dans le cache de schéma, 42P01 = relation inexistante
+    return getattr(e, "code", None) in ("PGRST205", "42P01")
 
 # ======================
 # CONFIG
 # ======================
-NOM_SHEET = "Indisponibilites-enseignants-configs"
-ONGLET_DONNEES = "Feuille 1"
+NOM_SHEET = "Indisponibilites-enseignants-configs"  # classeur du département par défaut
 ONGLET_USERS = "Utilisateurs"
-ADMIN_IASSWORD = st.secrets.get("admin_Iassword", "monmotdepasse")  # 🔑 mot de passe admin
+
+# ======================
+# DÉPARTEMENTS (UN SEUL SERVEUR POUR PLUSIEURS DÉPARTEMENTS)
+# ======================
+# Chaque département a son classeur, son schéma Supabase (mêmes tables et fonctions
+# que public, voir sql/departement.sql) et son expéditeur, dans secrets.toml :
+#
+#     [departements.mp]
+#     nom = "Mesures Physiques"
+#     classeur = "Indisponibilites-MP"
+#     schema = "mp"
+#
+# Choix par l'URL (?departement=mp), sinon DEPARTEMENT_DEFAUT, sinon le premier.
+# Les clients (Supabase, Google Sheets, Brevo) et les threads d'arrière-plan sont
+# partagés ; les caches et états partagés sont propres à chaque département.
+def departements():
+    declares = st.secrets.get("departements") or {"geii": {"nom": "GEII"}}
+    return {
+        code.lower(): {
+            "code": code.lower(),
+            "nom": d.get("nom", code.upper()),
+            "classeur": d.get("classeur", NOM_SHEET),
+            "schema": d.get("schema", "public"),
+            "expediteur": d.get("expediteur", f"Planning {d.get('nom', code.upper())}"),
+            "admin_Iassword": d.get("admin_Iassword")
+        }
+        for code, d in declares.items()
+    }
+
+DEPARTEMENTS = departements()
+code_departement = (
+    st.query_params.get("departement") or st.secrets.get("DEPARTEMENT_DEFAUT") or next(iter(DEPARTEMENTS))
+).lower()
+if code_departement not in DEPARTEMENTS:
+    st.error(f"⚠️ Département inconnu : {code_departement}")
+    st.stop()
+DEPARTEMENT = DEPARTEMENTS[code_departement]
+
+if st.session_state.setdefault("_departement", code_departement) != code_departement:
+    # autre département dans le même onglet : rien de la session précédente n'est valable
+    st.session_state.clear()
+    st.session_state._departement = code_departement
+
+ADMIN_IASSWORD = DEPARTEMENT["admin_Iassword"] or st.secrets.get("admin_Iassword", "monmotdepasse")  # 🔑 mot de passe admin
+
+@st.cache_resource
+def etats_partages():
+    # nom de l'état -> code département -> état (partagé entre les sessions du département)
+    return {}
+
+def etat_departement(nom, initial, departement=None):
+    # departement : imposé par les threads d'arrière-plan, sinon celui de la session
+    par_departement = etats_partages().setdefault(nom, {})
+    return par_departement.setdefault(departement or DEPARTEMENT["code"], initial)
 
 # ======================
 # CONFIGURATION BREVO
 # ======================
-configuration = Configuration()
-configuration.api_key['api-key'] = st.secrets["BREVO_API_KEY"]
+@st.cache_resource
+def api_brevo():
+    if services_locaux():
+        from bench.faux_services import ApiEmailsLocale
+        return ApiEmailsLocale()
+    with chronometrer("import sib_api_v3_sdk"):
+        from sib_api_v3_sdk import Configuration, ApiClient
+        from sib_api_v3_sdk.api.transactional_emails_api import TransactionalEmailsApi
+    configuration = Configuration()
+    configuration.api_key['api-key'] = st.secrets["BREVO_API_KEY"]
+    return TransactionalEmailsApi(ApiClient(configuration))
+
+def fabrique_message_brevo():
+    if services_locaux():
+        return dict
+    from sib_api_v3_sdk.models import SendSmtpEmail
+    return SendSmtpEmail
 
-def envoyer_email(destinataire, sujet, contenu):
+# ======================
+# BOÎTE D'ENVOI (EMAILS EN ARRIÈRE-PLAN)
+# ======================
+# Les emails sont envoyés par un thread unique (partagé entre sessions) avec un client
+# Brevo réutilisé ; chaque message est écrit dans la table "emails" par ce thread
+# avant son premier essai, puis son statut y est tenu à jour : la mise en file ne fait
+# aucun appel réseau. Un échec temporaire replanifie le message (délai doublé à
+# chaque essai) sans retarder les suivants.
+ESSAIS_MAX = 5
+DELAI_BASE_ESSAI = 2        # secondes, doublé à chaque nouvel essai
+INTERVALLE_MIN_ENVOI = 0.2  # secondes entre deux appels Brevo (≈ 5 / s)
+MAX_EMAILS_TRAITES = 50     # derniers messages traités gardés en mémoire (repli admin)
+
+def persister_email(supabase, message):
     try:
-        api_instance = TransactionalEmailsApi(ApiClient(configuration))
-        send_smtp_email = SendSmtpEmail(
-            to=[{"email": destinataire}],
-            sender={"email": st.secrets["EMAIL_FROM"], "name": "Planning GEII"},
-            subject=sujet,
-            text_content=contenu
-        )
-        api_instance.send_transac_email(send_smtp_email)
-        return True, ""
-    except Exception as e:
-        return False, str(e)
+        champs = {
+            "destinataire": message["destinataire"],
+            "sujet": message["contenu"].get("subject", ""),
+            "message": message["contenu"],
+            "statut": message["statut"],
+            "tentatives": message["tentatives"],
+            "erreur": message["erreur"]
+        }
+        if message.get("id") is None:
+            message["id"] = supabase.table("emails").insert(champs).execute().data[0]["id"]
+        else:
+            supabase.table("emails").update(champs).eq("id", message["id"]).execute()
+    except Exception:
+        pass  # le suivi ne doit jamais bloquer l'envoi
+
+def erreur_definitive(e):
+    # 4xx (hors 429) : adresse ou contenu invalide, inutile de réessayer
+    statut = getattr(e, "status", None)
+    return statut is not None and 400 <= statut < 500 and statut != 429
+
+def reprendre_emails(etat):
+    # Messages restés en attente (redémarrage du conteneur), tous départements ; lue avant
+    # tout envoi, la table ne contient pas encore les messages mis en file depuis
+    for schema in sorted({d["schema"] for d in DEPARTEMENTS.values()}):
+        try:
+            en_attente = client_schema(schema).table("emails").select("*").eq("statut", "en_attente").order("id").execute().data
+        except Exception:
+            en_attente = []
+        for r in en_attente:
+            planifier_email(etat, {
+                "id": r["id"], "destinataire": r["destinataire"], "contenu": r["message"], "schema": schema,
+                "statut": "en_attente", "tentatives": r.get("tentatives") or 0, "erreur": ""
+            })
+
+def traiter_boite_envoi(etat, api_instance, SendSmtpEmail):
+    # Un essai par message à la fois : un message en échec est replanifié (prochain_essai)
+    # sans bloquer les suivants
+    journal = etat["journal"]
+    dernier_envoi = 0.0
+    reprendre_emails(etat)
+    while True:
+        with etat["condition"]:
+            while not etat["file"] or etat["file"][0][0] > time.monotonic():
+                etat["condition"].wait(etat["file"][0][0] - time.monotonic() if etat["file"] else None)
+            _, _, message = heapq.heappop(etat["file"])
+        # suivi dans la table emails du département qui a envoyé le message
+        supabase = instrumenter_supabase(client_schema(message["schema"]), journal, CONTEXTE_BOITE_ENVOI)
+        if message["id"] is None:
+            persister_email(supabase, message)  # en_attente : repris après un redémarrage
+        attente = INTERVALLE_MIN_ENVOI - (time.monotonic() - dernier_envoi)
+        if attente > 0:
+            time.sleep(attente)
+        message["tentatives"] += 1
+        try:
+            appel_instrumente(
+                journal, CONTEXTE_BOITE_ENVOI, "brevo", "send_transac_email",
+                lambda: api_instance.send_transac_email(SendSmtpEmail(**message["contenu"])),
+                taille=lambda _: taille_json(message["contenu"])
+            )
+            message.update(statut="envoye", erreur="")
+        except Exception as e:
+            message["erreur"] = str(e)
+            if not erreur_definitive(e) and message["tentatives"] < ESSAIS_MAX:
+                # reste en_attente dans la table : repris après un redémarrage
+                persister_email(supabase, message)
+                planifier_email(etat, message, DELAI_BASE_ESSAI * 2 ** (message["tentatives"] - 1))
+                continue
+            message["statut"] = "echec"
+        finally:
+            dernier_envoi = time.monotonic()
+        persister_email(supabase, message)
+        etat["traites"].append(message)
+
+def planifier_email(etat, message, delai=0):
+    with etat["condition"]:
+        heapq.heappush(etat["file"], (time.monotonic() + delai, next(etat["sequence"]), message))
+        etat["condition"].notify()
+
+@st.cache_resource
+def boite_envoi():
+    # file : tas (prochain essai, ordre d'arrivée, message)
+    etat = {
+        "file": [], "condition": threading.Condition(), "sequence": itertools.count(),
+        "traites": deque(maxlen=MAX_EMAILS_TRAITES), "journal": journal_appels()
+    }
+    # reprise des messages en attente faite par le thread : aucun appel réseau ici
+    threading.Thread(
+        target=traiter_boite_envoi, args=(etat, api_brevo(), fabrique_message_brevo()), daemon=True, name="boite-envoi"
+    ).start()
+    return etat
+
+def nouveau_message(destinataire, contenu, schema):
+    # schema : département qui envoie (suivi dans sa table emails)
+    return {
+        "id": None, "destinataire": destinataire, "contenu": contenu, "schema": schema,
+        "statut": "en_attente", "tentatives": 0, "erreur": ""
+    }
+
+def mettre_en_file_email(destinataire, contenu):
+    # contenu : arguments de SendSmtpEmail (sérialisables en JSON) ; le message est
+    # écrit dans la table emails par le thread d'envoi (aucun appel réseau ici)
+    planifier_email(boite_envoi(), nouveau_message(destinataire, contenu, DEPARTEMENT["schema"]))
+
+def contenu_email(destinataire, sujet, contenu):
+    return {
+        "to": [{"email": destinataire}],
+        "sender": {"email": st.secrets["EMAIL_FROM"], "name": DEPARTEMENT["expediteur"]},
+        "subject": sujet,
+        "text_content": contenu
+    }
+
+# ======================
+# RELANCES (ENVOI GROUPÉ)
+# ======================
+TAILLE_LOT_RAPPELS = 500  # versions de message par appel Brevo (max 1000)
+
+MODELE_RAPPEL = """Bonjour {{params.prenom}} {{params.nom}},
+
+Sauf erreur de notre part, vous n'avez pas encore saisi vos indisponibilités ({{params.periode}}).
+Merci de les renseigner dès que possible dans l'application de planning.{{params.lien}}
+
+Cordialement,
+Service """ + DEPARTEMENT["expediteur"]
+
+def enseignants_sans_saisie():
+    # Anti-jointure PostgREST : enseignants sans aucune ligne dans datas (ni règle), en 1 requête
+    if etat_regles()["disponible"]:
+        try:
+            return (
+                client_supabase().table("enseignants").select("id,code,nom,prenom,email,datas(),regles()")
+                .is_("datas", "null").is_("regles", "null").order("code").execute().data
+            )
+        except Exception as e:
+            if not erreur_table_absente(e) and getattr(e, "code", None) != "PGRST200":
+                raise
+            etat_regles()["disponible"] = False
+    return (
+        client_supabase().table("enseignants").select("id,code,nom,prenom,email,datas()")
+        .is_("datas", "null").order("code").execute().data
+    )
+
+def parametres_rappel(enseignant, periode):
+    lien = st.secrets.get("APP_URL", "")
+    if lien and len(DEPARTEMENTS) > 1:
+        lien += f"?departement={DEPARTEMENT['code']}"
+    return {
+        "code": enseignant["code"],
+        "nom": enseignant.get("nom") or "",
+        "prenom": enseignant.get("prenom") or "",
+        "periode": periode,
+        "lien": f"\n{lien}" if lien else ""
+    }
+
+def rendre_rappel(modele, params):
+    for k, v in params.items():
+        modele = modele.replace(f"{{{{params.{k}}}}}", str(v))
+    return modele
+
+def envoyer_rappels(destinataires, sujet, modele, periode):
+    # 1 appel Brevo par lot (messageVersions), mis en file dans la boîte d'envoi
+    for i in range(0, len(destinataires), TAILLE_LOT_RAPPELS):
+        lot = destinataires[i:i + TAILLE_LOT_RAPPELS]
+        mettre_en_file_email(f"{len(lot)} destinataire(s) (relance)", {
+            "sender": {"email": st.secrets["EMAIL_FROM"], "name": DEPARTEMENT["expediteur"]},
+            "subject": sujet,
+            "text_content": modele,
+            "message_versions": [
+                {
+                    "to": [{"email": e["email"], "name": f"{e.get('prenom') or ''} {e.get('nom') or ''}".strip()}],
+                    "params": parametres_rappel(e, periode)
+                }
+                for e in lot
+            ]
+        })
 
 
 # ======================
@@ -61,123 +478,611 @@ def envoyer_email(destinataire, sujet, contenu):
 # ======================
 # AUTH GOOGLE
 # ======================
-creds = Credentials.from_service_account_info(
-    st.secrets["gcp_service_account"],
-    scopes=[
-        "https://www.googleapis.com/auth/spreadsheets",
-        "https://www.googleapis.com/auth/drive"
-    ]
-)
-client = gspread.authorize(creds)
+@st.cache_resource
+def client_sheets():
+    # Partagé par toutes les sessions et tous les départements : 1 seule authentification
+    with chronometrer("import gspread"):
+        import gspread
+        from google.oauth2.service_account import Credentials
+    creds = Credentials.from_service_account_info(
+        st.secrets["gcp_service_account"],
+        scopes=[
+            "https://www.googleapis.com/auth/spreadsheets",
+            "https://www.googleapis.com/auth/drive"
+        ]
+    )
+    return gspread.authorize(creds)
+
+@st.cache_resource
+def ouvrir_classeur(nom):
+    # 1 ouverture par classeur (département)
+    if services_locaux():
+        from bench.faux_services import ClasseurLocal
+        return ClasseurLocal()
+    client = client_sheets()
+    with chronometrer("ouverture classeur Google Sheets"):
+        return appel_instrumente(journal_appels(), CONTEXTE_EXECUTION, "sheets", "open", lambda: client.open(nom))
+
+@st.cache_resource
+def feuille_config(nom):
+    return appel_instrumente(
+        journal_appels(), CONTEXTE_EXECUTION, "sheets", "worksheet(Config)",
+        lambda: ouvrir_classeur(nom).worksheet("Config")
+    )
+
+def appel_sheets(operation, fonction):
+    return appel_instrumente(journal_appels(), CONTEXTE_EXECUTION, "sheets", operation, fonction)
 
 # ======================
-# CHARGEMENT DES FEUILLES
+# DONNÉES DE RÉFÉRENCE (CACHE PARTAGÉ)
 # ======================
+# Source : table Supabase `reference` (sql/reference.sql, remplie par
+# outils/migrer_reference.py) ; classeur Google Sheets en repli, tant que la
+# table est absente ou vide.
+ONGLETS_REFERENCE = ["Creneaux", "Jours", "Semaines", ONGLET_USERS, "Config"]
+TTL_REFERENCE = 600  # secondes
+
+def completer_lignes(rows):
+    # L'API renvoie des lignes sans les cellules vides finales : on les complète
+    largeur = max((len(r) for r in rows), default=0)
+    return [r + [""] * (largeur - len(r)) for r in rows]
+
+def tables_reference(onglets, version=None):
+    tables = {onglet: completer_lignes(onglets.get(onglet, [])) for onglet in ONGLETS_REFERENCE}
+    tables["version"] = version or hashlib.md5(repr([tables[o] for o in ONGLETS_REFERENCE]).encode()).hexdigest()
+    return tables
+
+def etat_reference():
+    # Partagé entre sessions : source courante, RPC disponible et dernière lecture
+    # (renvoyée telle quelle quand la version n'a pas changé)
+    return etat_departement("reference", {"source": "supabase", "rpc": True, "tables": None})
+
+def lire_reference_supabase(etat):
+    client = client_supabase()
+    if etat["rpc"]:
+        precedente = etat["tables"]["version"] if etat["tables"] else None
+        try:
+            reponse = client.rpc("lire_reference", {"p_version": precedente}).execute().data
+        except Exception as e:
+            if not erreur_fonction_absente(e):
+                raise
+            etat["rpc"] = False
+        else:
+            if "onglets" not in reponse:
+                return etat["tables"]
+            return tables_reference(reponse["onglets"], reponse["version"]) if reponse["onglets"] else None
+    lignes = client.table("reference").select("onglet,lignes").execute().data
+    return tables_reference({l["onglet"]: l["lignes"] for l in lignes}) if lignes else None
+
+def lire_reference_sheets():
+    # Tous les onglets de référence en 1 seul appel à l'API Sheets
+    classeur = ouvrir_classeur(DEPARTEMENT["classeur"])
+    reponse = appel_sheets(
+        "values_batch_get", lambda: classeur.values_batch_get([f"'{o}'" for o in ONGLETS_REFERENCE])
+    )
+    return tables_reference({
+        onglet: vr.get("values", []) for onglet, vr in zip(ONGLETS_REFERENCE, reponse["valueRanges"])
+    })
+
+@st.cache_data(ttl=TTL_REFERENCE, show_spinner=False)
+def charger_donnees_reference(departement):
+    # departement : une entrée de cache par département
+    etat = etat_reference()
+    tables = None
+    with chronometrer("lecture données de référence"):
+        if etat["source"] == "supabase":
+            try:
+                tables = lire_reference_supabase(etat)
+            except Exception as e:
+                if not erreur_table_absente(e):
+                    raise
+            if tables is None:
+                # table absente ou pas encore migrée
+                etat["source"] = "sheets"
+        if tables is None:
+            tables = lire_reference_sheets()
+    etat["tables"] = tables
+    return tables
+
+def ecrire_config(config_rows, semestre):
+    # Filtre semestre en 2e ligne de Config, dans la source des données de référence
+    if etat_reference()["source"] == "supabase":
+        config = [list(r) for r in config_rows] or [["semestre_filter"]]
+        config[1:2] = [[semestre] + (config[1][1:] if len(config) > 1 else [])]
+        client_supabase().table("reference").upsert(
+            {"onglet": "Config", "lignes": config, "modifie_le": datetime.now().astimezone().isoformat()},
+            on_conflict="onglet"
+        ).execute()
+    else:
+        config_sheet = feuille_config(DEPARTEMENT["classeur"])
+        appel_sheets("update(Config)", lambda: config_sheet.update("A2", [[semestre]]))
+
 try:
-    if "sheet" not in st.session_state:
-        st.session_state.sheet = client.open(NOM_SHEET).worksheet(ONGLET_DONNEES)
-    if "users_sheet" not in st.session_state:
-        st.session_state.users_sheet = client.open(NOM_SHEET).worksheet(ONGLET_USERS)
-    if "creneaux_sheet" not in st.session_state:
-        st.session_state.creneaux_sheet = client.open(NOM_SHEET).worksheet("Creneaux")
-    if "jours_sheet" not in st.session_state:
-        st.session_state.jours_sheet = client.open(NOM_SHEET).worksheet("Jours")
-    if "semaines_sheet" not in st.session_state:
-        st.session_state.semaines_sheet = client.open(NOM_SHEET).worksheet("Semaines")
-    if "config_sheet" not in st.session_state:
-        st.session_state.config_sheet = client.open(NOM_SHEET).worksheet("Config")
+    reference = charger_donnees_reference(DEPARTEMENT["code"])
 except Exception as e:
-    st.error(f"Impossible d'accéder à une des feuilles Google Sheet.\n{e}")
+    st.error(f"Impossible de charger les données de référence.\n{e}")
     st.stop()
 
+creneaux_data = reference["Creneaux"][1:]
+jours_data = reference["Jours"][1:]
+semaines_data = reference["Semaines"][1:]
+users_data = reference[ONGLET_USERS][1:]
+
 # ======================
 # LECTURE CONFIG AU DEMARRAGE
 # ======================
 if "semestre_filter" not in st.session_state:
-    try:
-        config_rows = st.session_state.config_sheet.get_all_values()
-        if len(config_rows) > 1 and config_rows[1]:
-            st.session_state.semestre_filter = config_rows[1][0]
-        else:
-            st.session_state.semestre_filter = "Toutes"
-    except:
+    config_rows = reference["Config"]
+    if len(config_rows) > 1 and config_rows[1] and config_rows[1][0]:
+        st.session_state.semestre_filter = config_rows[1][0]
+    else:
         st.session_state.semestre_filter = "Toutes"
 
 #st.write(f"Config chargée au démarrage : {st.session_state.semestre_filter}")
 
 # ======================
-# CHARGEMENT DES DONNÉES EN SESSION
+# INDEX DE RÉSOLUTION CRÉNEAUX, JOURS, SEMAINES
 # ======================
-if "creneaux_data" not in st.session_state:
-    st.session_state.creneaux_data = st.session_state.creneaux_sheet.get_all_values()[1:]
-if "jours_data" not in st.session_state:
-    st.session_state.jours_data = st.session_state.jours_sheet.get_all_values()[1:]
-if "semaines_data" not in st.session_state:
-    st.session_state.semaines_data = st.session_state.semaines_sheet.get_all_values()[1:]
-if "users_data" not in st.session_state:
-    st.session_state.users_data = st.session_state.users_sheet.get_all_values()[1:]
-if "all_data" not in st.session_state:
-    st.session_state.all_data = st.session_state.sheet.get_all_values()
+def construire_index(rows):
+    # rows : [libellé, code, groupe] ; un code ALL_xxx désigne tout le groupe
+    labels = {r[0]: r[1] for r in rows if len(r) >= 2}
+    groupes = {}
+    for r in rows:
+        if len(r) >= 3 and not r[1].startswith("ALL_"):
+            groupes.setdefault(r[2], []).append(r[1])
+
+    membres = {}
+    for r in rows:
+        if len(r) < 2:
+            continue
+        if r[1].startswith("ALL_"):
+            membres[r[0]] = groupes.get(r[2] if len(r) >= 3 else "", [])
+        else:
+            membres[r[0]] = [r[1]]
+
+    codes = [r[1] for r in rows if len(r) >= 2 and not r[1].startswith("ALL_")]
+    return {
+        "groupe_de": {r[1]: r[2] for r in rows if len(r) >= 3},
+        "labels": labels,
+        "membres": membres,
+        "codes": codes,
+        "positions": {c: i for i, c in enumerate(codes)},  # axe de la grille numpy
+        "code_vers_label": {v: k for k, v in labels.items()}
+    }
+
+@st.cache_resource(max_entries=4)
+def construire_index_reference(version, _reference):
+    # Reconstruit uniquement quand le contenu des onglets change (version = hash)
+    return {
+        "creneaux": construire_index(_reference["Creneaux"][1:]),
+        "jours": construire_index(_reference["Jours"][1:]),
+        "semaines": construire_index(_reference["Semaines"][1:])
+    }
+
+def resoudre_selection(index, selection):
+    result = []
+    for label in selection:
+        result.extend(index["membres"].get(label, []))
+    return result
+
+INDEX = construire_index_reference(reference["version"], reference)
+
+CODE_TO_JOUR = INDEX["jours"]["code_vers_label"]
+CODE_TO_CREN = INDEX["creneaux"]["code_vers_label"]
+CODE_TO_SEMAINE = INDEX["semaines"]["code_vers_label"]
+
+# Clé canonique d'un créneau : (semaine, jour, creneau), identique côté session et côté base
+def cle_creneau(semaine, jour, creneau):
+    return (str(semaine or ""), jour or "", creneau or "")
+
+def code_streamlit(user_code, cle):
+    semaine, jour, creneau = cle
+    return f"{user_code}_{semaine}_{jour}_{creneau}_I"
 
 # ======================
-# DICTIONNAIRES CRÉNEAUX, JOURS, SEMAINES
+# GRILLE D'INDISPONIBILITÉS (NUMPY)
 # ======================
-CRENEAUX_LABELS = {r[0]: r[1] for r in st.session_state.creneaux_data if len(r) >= 2}
-CRENEAUX_GROUPES = {r[0]: r[2] for r in st.session_state.creneaux_data if len(r) >= 3}
+# Tableau booléen semaines x jours x créneaux ; les raisons restent dans ponctuels.
+AXES_GRILLE = ("semaines", "jours", "creneaux")
+FORME_GRILLE = tuple(len(INDEX[axe]["codes"]) for axe in AXES_GRILLE)
+
+def grille_vide():
+    return np.zeros(FORME_GRILLE, dtype=bool)
+
+def cles_vers_grille(cles):
+    grille = grille_vide()
+    pos = [INDEX[axe]["positions"] for axe in AXES_GRILLE]
+    indices = [
+        (pos[0][s], pos[1][j], pos[2][c]) for s, j, c in cles
+        if s in pos[0] and j in pos[1] and c in pos[2]
+    ]
+    if indices:
+        grille[tuple(np.array(indices).T)] = True
+    return grille
+
+def grille_vers_cles(grille):
+    codes = [INDEX[axe]["codes"] for axe in AXES_GRILLE]
+    return [(codes[0][i], codes[1][j], codes[2][k]) for i, j, k in np.argwhere(grille)]
+
+def selection_vers_grille(semaines, jours, creneaux):
+    # Produit cartésien de la sélection en une seule affectation vectorisée
+    grille = grille_vide()
+    axes = [
+        [INDEX[axe]["positions"][c] for c in codes if c in INDEX[axe]["positions"]]
+        for axe, codes in zip(AXES_GRILLE, (semaines, jours, creneaux))
+    ]
+    grille[np.ix_(*axes)] = True
+    return grille
+
+def compacter_grille(grille):
+    return np.packbits(grille, axis=None).tobytes()
 
-JOURS_LABELS = {r[0]: r[1] for r in st.session_state.jours_data if len(r) >= 2}
-JOURS_GROUPES = {r[0]: r[2] for r in st.session_state.jours_data if len(r) >= 3}
+def decompacter_grille(octets):
+    bits = np.unpackbits(np.frombuffer(octets, dtype=np.uint8), count=int(np.prod(FORME_GRILLE)))
+    return bits.astype(bool).reshape(FORME_GRILLE)
 
-SEMAINES_LABELS = {r[0]: r[1] for r in st.session_state.semaines_data if len(r) >= 2}
-SEMAINES_GROUPES = {r[0]: r[2] for r in st.session_state.semaines_data if len(r) >= 3}
+def enregistrer_grille_session(grille):
+    st.session_state.grille = compacter_grille(grille)
+    st.session_state.grille_version = reference["version"]
 
-CODE_TO_JOUR = {v: k for k, v in JOURS_LABELS.items()}
-CODE_TO_CREN = {v: k for k, v in CRENEAUX_LABELS.items()}
+def reconstruire_grille_session():
+    enregistrer_grille_session(
+        cles_vers_grille(st.session_state.ponctuels) | grille_regles(st.session_state.regles.values())
+    )
+
+def grille_session():
+    # Reconstruite depuis ponctuels et les règles si les onglets de référence ont changé entre-temps
+    if st.session_state.get("grille_version") != reference["version"]:
+        reconstruire_grille_session()
+    return decompacter_grille(st.session_state.grille)
 
 # ======================
-# FONCTIONS UTILITAIRES
+# RÈGLES RÉCURRENTES
 # ======================
-def get_creneaux_nums(selection):
-    result = []
-    for c in selection:
-        if c not in CRENEAUX_LABELS:
-            continue
-        code_num = CRENEAUX_LABELS[c]
-        groupe = CRENEAUX_GROUPES[c]
-        if code_num.startswith("ALL_"):
-            nums_du_groupe = [r[1] for r in st.session_state.creneaux_data if r[2] == groupe and not r[1].startswith("ALL_")]
-            result.extend(nums_du_groupe)
+# Une règle = produit semaines x jours x créneaux, une raison et des exceptions
+# (créneaux retirés). Stockée telle quelle (table regles) et développée en
+# créneaux uniquement pour les vues à plat : export, carte de chaleur, email, masques.
+SEUIL_REGLE = 12  # créneaux : une sélection plus grande est conservée comme règle
+COLONNES_REGLES = "id,enseignant_id,semaines,jours,creneaux,raison,exceptions,timestamp"
+
+def etat_regles():
+    # Partagé entre sessions : table regles absente -> règles développées en lignes datas
+    return etat_departement("regles", {"disponible": True})
+
+def grille_regle(regle):
+    grille = selection_vers_grille(regle["semaines"], regle["jours"], regle["creneaux"])
+    if regle.get("exceptions"):
+        grille &= ~cles_vers_grille([tuple(e) for e in regle["exceptions"]])
+    return grille
+
+def grille_regles(regles):
+    grille = grille_vide()
+    for regle in regles:
+        grille |= grille_regle(regle)
+    return grille
+
+def cles_regle(regle):
+    return grille_vers_cles(grille_regle(regle))
+
+def nouvelle_regle(semaines, jours, creneaux, raison, exceptions):
+    return {
+        "id": None,
+        "semaines": list(semaines),
+        "jours": list(jours),
+        "creneaux": list(creneaux),
+        "raison": raison,
+        "exceptions": [list(e) for e in exceptions]
+    }
+
+def regle_depuis_ligne(r):
+    regle = nouvelle_regle(r.get("semaines") or [], r.get("jours") or [], r.get("creneaux") or [], r.get("raison") or "", r.get("exceptions") or [])
+    regle["id"] = r["id"]
+    return regle
+
+def regles_depuis_lignes(rows):
+    # clé locale stable (widgets) -> règle
+    return {f"r{r['id']}": regle_depuis_ligne(r) for r in rows}
+
+def charger_regles_session(regles_rows):
+    installer_regles_session(regles_depuis_lignes(regles_rows))
+
+def installer_regles_session(regles):
+    st.session_state.regles = regles
+    for k in [k for k in st.session_state if str(k).startswith("exceptions_")]:
+        if k[len("exceptions_"):] not in st.session_state.regles:
+            del st.session_state[k]  # widgets des règles disparues
+
+def ponctuels_avec_regles(ponctuels, regles):
+    # Vue à plat : créneaux ponctuels + créneaux développés des règles
+    tous = dict(ponctuels)
+    for regle in regles:
+        for cle in cles_regle(regle):
+            tous.setdefault(cle, {"raison": regle.get("raison", "")})
+    return tous
+
+def resumer_codes(axe, codes):
+    # Plages de codes consécutifs dans l'ordre de l'onglet : "36–40, 42"
+    index = INDEX[axe]
+    positions = sorted(index["positions"][c] for c in codes if c in index["positions"])
+    libelle = lambda p: index["code_vers_label"].get(index["codes"][p], index["codes"][p])
+    plages = []
+    for p in positions:
+        if plages and p == plages[-1][1] + 1:
+            plages[-1][1] = p
         else:
-            result.append(code_num)
-    return result
+            plages.append([p, p])
+    return ", ".join(libelle(a) if a == b else f"{libelle(a)}–{libelle(b)}" for a, b in plages)
 
-def get_jours_codes(selection):
-    result = []
-    for label in selection:
-        if label not in JOURS_LABELS:
-            continue
-        code_num = JOURS_LABELS[label]
-        groupe = JOURS_GROUPES[label]
-        if code_num.startswith("ALL_"):
-            nums_du_groupe = [r[1] for r in st.session_state.jours_data if r[2] == groupe and not r[1].startswith("ALL_")]
-            result.extend(nums_du_groupe)
-        else:
-            result.append(code_num)
-    return result
+def libelle_regle(regle):
+    return " · ".join(resumer_codes(axe, regle[cle]) for axe, cle in zip(AXES_GRILLE, ("semaines", "jours", "creneaux")))
 
-def get_semaines_nums(selection):
-    result = []
-    for label in selection:
-        if label not in SEMAINES_LABELS:
+# ======================
+# IMPORT CSV / ICALENDAR
+# ======================
+NOMS_JOURS = ["lundi", "mardi", "mercredi", "jeudi", "vendredi", "samedi", "dimanche"]
+FUSEAU_HORAIRE = "Europe/Paris"  # heures UTC (suffixe Z) des fichiers .ics
+MAX_JOURS_EVENEMENT = 366
+MAX_JOURS_RECURRENCE = 2 * 366  # horizon d'un événement récurrent sans fin
+MAX_OCCURRENCES_ICS = 500
+JOURS_RRULE = {"MO": 0, "TU": 1, "WE": 2, "TH": 3, "FR": 4, "SA": 5, "SU": 6}
+COLONNES_IMPORT = ["ligne", "source", "date", "debut", "fin", "semaine", "jour", "creneau", "raison", "motif"]
+ALIAS_COLONNES_IMPORT = {
+    "date": "date", "jour_date": "date",
+    "debut": "debut", "début": "debut", "heure_debut": "debut", "heure début": "debut",
+    "fin": "fin", "heure_fin": "fin", "heure fin": "fin",
+    "semaine": "semaine", "jour": "jour", "creneau": "creneau", "créneau": "creneau",
+    "raison": "raison", "raisons": "raison", "commentaire": "raison"
+}
+MOTIF_PLAGE_HORAIRE = re.compile(r"(\d{1,2})\s*[h:]\s*(\d{2})?\s*(?:-|–|à|a)\s*(\d{1,2})\s*[h:]\s*(\d{2})?")
+MOTIF_HEURE = r"^\s*(\d{1,2})\s*[h:]?\s*(\d{2})?\s*$"
+
+@st.cache_resource(max_entries=4)
+def construire_table_import(version, _reference):
+    # Correspondances date/heure -> codes, recalculées seulement quand la référence change
+    lignes = {o: [r for r in _reference[o][1:] if len(r) >= 2 and r[1] and not r[1].startswith("ALL_")] for o in ("Semaines", "Jours", "Creneaux")}
+
+    semaine_par_numero = {}
+    for r in lignes["Semaines"]:
+        numero = re.search(r"\d+", r[1]) or re.search(r"\d+", r[0])
+        if numero:
+            semaine_par_numero.setdefault(int(numero.group()), r[1])
+
+    jour_par_index = {}
+    for position, r in enumerate(lignes["Jours"]):
+        nom = r[0].strip().lower()
+        jour_par_index[NOMS_JOURS.index(nom) if nom in NOMS_JOURS else position] = r[1]
+
+    # Intervalles [début, fin[ en minutes, triés : recherche par np.searchsorted
+    intervalles = []
+    for r in lignes["Creneaux"]:
+        plage = MOTIF_PLAGE_HORAIRE.search(r[3] if len(r) > 3 and r[3] else r[0])
+        if plage:
+            h1, m1, h2, m2 = plage.groups()
+            intervalles.append((int(h1) * 60 + int(m1 or 0), int(h2) * 60 + int(m2 or 0), r[1]))
+    intervalles.sort()
+
+    codes = {}
+    for onglet, axe in (("Semaines", "semaine"), ("Jours", "jour"), ("Creneaux", "creneau")):
+        codes[axe] = {}
+        for r in lignes[onglet]:
+            codes[axe][r[1].strip().lower()] = r[1]
+            codes[axe].setdefault(r[0].strip().lower(), r[1])
+    return {
+        "semaine_par_numero": semaine_par_numero,
+        "jour_par_index": jour_par_index,
+        "debuts": np.array([i[0] for i in intervalles], dtype=np.int32),
+        "fins": np.array([i[1] for i in intervalles], dtype=np.int32),
+        "creneaux": np.array([i[2] for i in intervalles], dtype=object),
+        "codes": codes
+    }
+
+def lire_csv_import(contenu):
+    import csv
+    import io
+
+    texte = contenu.decode("utf-8-sig", errors="replace")
+    try:
+        separateur = csv.Sniffer().sniff(texte[:4096], delimiters=";,\t").delimiter
+    except csv.Error:
+        separateur = ";"
+    lecteur = csv.reader(io.StringIO(texte), delimiter=separateur)
+    entete = [ALIAS_COLONNES_IMPORT.get(c.strip().lower()) for c in next(lecteur, [])]
+    for numero, valeurs in enumerate(lecteur, start=2):
+        if not any(v.strip() for v in valeurs):
             continue
-        code_num = SEMAINES_LABELS[label]
-        groupe = SEMAINES_GROUPES[label]
-        if code_num.startswith("ALL_"):
-            nums_du_groupe = [r[1] for r in st.session_state.semaines_data if r[2] == groupe and not r[1].startswith("ALL_")]
-            result.extend(nums_du_groupe)
-        else:
-            result.append(code_num)
-    return result
+        ligne = {"ligne": numero, "source": separateur.join(valeurs)}
+        for colonne, valeur in zip(entete, valeurs):
+            if colonne:
+                ligne[colonne] = valeur.strip()
+        yield ligne
+
+def date_ics(parametres, valeur):
+    from zoneinfo import ZoneInfo
+
+    valeur = valeur.strip()
+    if "VALUE=DATE" in parametres.upper() or len(valeur) == 8:
+        return datetime.strptime(valeur[:8], "%Y%m%d"), True
+    moment = datetime.strptime(valeur.rstrip("Z")[:15], "%Y%m%dT%H%M%S")
+    if valeur.endswith("Z"):
+        moment = moment.replace(tzinfo=ZoneInfo("UTC")).astimezone(ZoneInfo(FUSEAU_HORAIRE)).replace(tzinfo=None)
+    return moment, False
+
+def occurrences_ics(evenement, debut):
+    from datetime import timedelta
+
+    # Débuts des occurrences d'un VEVENT : DTSTART seul, ou développé selon RRULE
+    # (FREQ=DAILY / WEEKLY avec INTERVAL, COUNT, UNTIL, BYDAY), moins les EXDATE.
+    # None si la règle n'est pas prise en charge (ligne rejetée avec son motif).
+    if "RRULE" not in evenement:
+        return [debut]
+    regle = dict(p.split("=", 1) for p in evenement["RRULE"][1].strip().upper().split(";") if "=" in p)
+    frequence = regle.pop("FREQ", "")
+    jours = regle.get("BYDAY", "").split(",") if regle.get("BYDAY") else []
+    if (
+        frequence not in ("DAILY", "WEEKLY") or "RDATE" in evenement
+        or set(regle) - {"INTERVAL", "COUNT", "UNTIL", "BYDAY", "WKST"}
+        or any(j not in JOURS_RRULE for j in jours)
+    ):
+        return None
+    intervalle = max(1, int(regle.get("INTERVAL", 1)))
+    nombre = int(regle["COUNT"]) if "COUNT" in regle else MAX_OCCURRENCES_ICS
+    limite = debut + timedelta(days=MAX_JOURS_RECURRENCE)
+    if "UNTIL" in regle:
+        fin_regle, journee = date_ics("", regle["UNTIL"])
+        limite = min(limite, fin_regle + timedelta(days=1, seconds=-1) if journee else fin_regle)
+    jours = {JOURS_RRULE[j] for j in jours} or ({debut.weekday()} if frequence == "WEEKLY" else set(range(7)))
+    exclues = {
+        date_ics(parametres, v)[0].date()
+        for parametres, valeurs in evenement.get("EXDATE", []) for v in valeurs.split(",") if v.strip()
+    }
+
+    occurrences = []
+    lundi = debut.date() - timedelta(days=debut.weekday())
+    moment = debut
+    while moment <= limite and nombre > 0:
+        ecart = (moment.date() - lundi).days // 7 if frequence == "WEEKLY" else (moment.date() - debut.date()).days
+        if ecart % intervalle == 0 and moment.weekday() in jours:
+            nombre -= 1  # COUNT inclut les occurrences exclues par EXDATE (RFC 5545)
+            if moment.date() not in exclues:
+                occurrences.append(moment)
+        moment += timedelta(days=1)
+    return occurrences
+
+def lire_ics_import(contenu):
+    from datetime import timedelta
+
+    # Dépliage des lignes longues (RFC 5545) puis lecture des VEVENT
+    texte = re.sub(r"\r?\n[ \t]", "", contenu.decode("utf-8", errors="replace"))
+    evenement = None
+    for numero, ligne in enumerate(texte.splitlines(), start=1):
+        if ligne.strip() == "BEGIN:VEVENT":
+            evenement = {"ligne": numero}
+        elif ligne.strip() == "END:VEVENT" and evenement is not None:
+            resume = evenement.get("SUMMARY", ("", ""))[1].replace("\\,", ",").replace("\\n", " ").strip()
+            source = f"{resume} ({evenement.get('DTSTART', ('', '?'))[1]})"
+            try:
+                debut, journee = date_ics(*evenement["DTSTART"])
+                fin, _ = date_ics(*evenement["DTEND"]) if "DTEND" in evenement else (debut + timedelta(days=1) if journee else debut, None)
+                debuts = occurrences_ics(evenement, debut)
+            except (KeyError, ValueError):
+                yield {"ligne": evenement["ligne"], "source": source, "date": "?"}
+                evenement = None
+                continue
+            if debuts is None:
+                yield {"ligne": evenement["ligne"], "source": source, "motif": "événement récurrent non pris en charge"}
+                evenement = None
+                continue
+            if journee:
+                fin -= timedelta(days=1)  # DTEND exclusif pour les journées entières
+            elif fin.date() > debut.date() and fin.time() == datetime.min.time():
+                fin -= timedelta(minutes=1)  # fin à minuit : la journée précédente
+            for occurrence in debuts:
+                fin_occurrence = occurrence + (fin - debut)
+                nb_jours = (fin_occurrence.date() - occurrence.date()).days + 1
+                for decalage in range(max(1, min(nb_jours, MAX_JOURS_EVENEMENT))):
+                    jour = occurrence.date() + timedelta(days=decalage)
+                    yield {
+                        "ligne": evenement["ligne"], "source": source, "date": jour.isoformat(),
+                        "debut": "" if journee or decalage > 0 else occurrence.strftime("%H:%M"),
+                        "fin": "" if journee or jour < fin_occurrence.date() else fin_occurrence.strftime("%H:%M"),
+                        "raison": resume
+                    }
+            evenement = None
+        elif evenement is not None and ":" in ligne:
+            parametres, valeur = ligne.split(":", 1)
+            nom = parametres.split(";")[0].upper()
+            if nom == "EXDATE":
+                evenement.setdefault(nom, []).append((parametres, valeur))  # propriété répétable
+            else:
+                evenement[nom] = (parametres, valeur)
+
+def lire_fichier_import(nom, contenu):
+    return list(lire_ics_import(contenu) if nom.lower().endswith(".ics") else lire_csv_import(contenu))
+
+def minutes_serie(serie):
+    heures = serie.str.extract(MOTIF_HEURE).astype(float)
+    return heures[0] * 60 + heures[1].fillna(0)
+
+def analyser_import(lignes, table, semaines_autorisees, grille):
+    import pandas as pd
+
+    df = pd.DataFrame(lignes, columns=COLONNES_IMPORT).fillna("").astype({"ligne": int})
+    for col in COLONNES_IMPORT[1:]:
+        df[col] = df[col].astype(str).str.strip()
+    motif = df["motif"].copy()  # motif déjà connu à la lecture (ex. récurrence non prise en charge)
+
+    # Lignes datées : semaine ISO et jour de la semaine ; sinon codes ou libellés
+    par_date = df["date"] != ""
+    dates = pd.to_datetime(df["date"], format="%Y-%m-%d", errors="coerce").fillna(
+        pd.to_datetime(df["date"], format="%d/%m/%Y", errors="coerce")
+    )
+    motif[(motif == "") & par_date & dates.isna()] = "date illisible"
+    semaine = dates.dt.isocalendar().week.astype("Int64").map(table["semaine_par_numero"])
+    jour = dates.dt.weekday.map(table["jour_par_index"])
+    df["semaine"] = semaine.where(par_date, df["semaine"].str.lower().map(table["codes"]["semaine"]))
+    df["jour"] = jour.where(par_date, df["jour"].str.lower().map(table["codes"]["jour"]))
+    motif[(motif == "") & df["semaine"].isna()] = "semaine inconnue"
+    motif[(motif == "") & ~df["semaine"].isin(semaines_autorisees)] = "semaine hors période"
+    motif[(motif == "") & df["jour"].isna()] = "jour inconnu ou non travaillé"
+
+    # Créneaux : code/libellé donné, sinon tous ceux qui recouvrent [début, fin[
+    par_code = df["creneau"] != ""
+    creneau_code = df["creneau"].str.lower().map(table["codes"]["creneau"])
+    motif[(motif == "") & par_code & creneau_code.isna()] = "créneau inconnu"
+    debut, fin = minutes_serie(df["debut"]), minutes_serie(df["fin"])
+    motif[(motif == "") & ~par_code & (((df["debut"] != "") & debut.isna()) | ((df["fin"] != "") & fin.isna()))] = "heure illisible"
+    debut, fin = debut.fillna(0).to_numpy(), fin.fillna(24 * 60).to_numpy()
+    premier = np.searchsorted(table["fins"], debut, side="right")
+    dernier = np.searchsorted(table["debuts"], fin, side="left")
+    nombre = np.where(par_code, creneau_code.notna(), np.clip(dernier - premier, 0, None))
+    motif[(motif == "") & (nombre == 0)] = "horaire hors des créneaux"
+
+    valides = (motif == "").to_numpy()
+    nombre = np.where(valides, nombre, 0)
+    lignes_eclatees = np.repeat(np.arange(len(df)), nombre)
+    decalage = np.arange(len(lignes_eclatees)) - np.repeat(np.cumsum(nombre) - nombre, nombre)
+    indices_creneaux = np.minimum(premier[lignes_eclatees] + decalage, max(len(table["creneaux"]) - 1, 0))
+    creneaux = np.where(
+        par_code.to_numpy()[lignes_eclatees],
+        creneau_code.to_numpy()[lignes_eclatees],
+        table["creneaux"][indices_creneaux] if len(table["creneaux"]) else None
+    )
+    eclate = pd.DataFrame({
+        "semaine": df["semaine"].to_numpy()[lignes_eclatees],
+        "jour": df["jour"].to_numpy()[lignes_eclatees],
+        "creneau": creneaux,
+        "raison": df["raison"].to_numpy()[lignes_eclatees]
+    })
+
+    # Dédoublonnage vectorisé : dans le fichier puis contre la grille de session
+    positions = [eclate[col].map(INDEX[axe]["positions"]) for col, axe in zip(("semaine", "jour", "creneau"), AXES_GRILLE)]
+    connus = positions[0].notna() & positions[1].notna() & positions[2].notna()
+    eclate = eclate[connus]
+    plats = np.ravel_multi_index(tuple(p[connus].astype(int).to_numpy() for p in positions), FORME_GRILLE)
+    _, premiers = np.unique(plats, return_index=True)
+    uniques = np.zeros(len(plats), dtype=bool)
+    uniques[premiers] = True
+    deja = grille.ravel()[plats]
+    nouveaux = eclate[uniques & ~deja]
+
+    rejets = df.loc[~valides, ["ligne", "source"]].assign(motif=motif[~valides])
+    return {
+        "nouveaux": [((s, j, c), r) for s, j, c, r in nouveaux.itertuples(index=False)],
+        "deja_presents": int((uniques & deja).sum()),
+        "doublons_fichier": int((~uniques).sum()),
+        "lignes_lues": len(df),
+        "rejets": rejets.rename(columns={"ligne": "Ligne", "source": "Contenu", "motif": "Motif"})
+    }
+
+def importer_creneaux(nouveaux):
+    ponctuels = st.session_state.ponctuels
+    for cle, raison in nouveaux:
+        ponctuels[cle] = {"raison": raison}
+    enregistrer_grille_session(grille_session() | cles_vers_grille([cle for cle, _ in nouveaux]))
+
+# ======================
+# FONCTIONS UTILITAIRES
+# ======================
 def generer_contenu_email(user_code, ponc, commentaire_global, timestamp):
     lines = [
         f"Bonjour {user_code},\n",
@@ -187,25 +1092,936 @@ def generer_contenu_email(user_code, ponc, commentaire_global, timestamp):
     ]
 
     if ponc:
-        for p in ponc:
-            semaine = p.get("semaine", "")
-            jour = CODE_TO_JOUR.get(p.get("jour",""), p.get("jour",""))
-            creneau = CODE_TO_CREN.get(p.get("creneau",""), p.get("creneau",""))
+        for (semaine, j_code, c_code), p in ponc.items():
+            jour = CODE_TO_JOUR.get(j_code, j_code)
+            creneau = CODE_TO_CREN.get(c_code, c_code)
             raison = p.get("raison","")
             lines.append(f"{semaine} | {jour} | {creneau} | {raison}")
     else:
         lines.append("Aucune indisponibilité enregistrée.")
 
     lines.append(f"\nCommentaire global : {commentaire_global or '-'}\n")
-    lines.append("Cordialement,\nService Planning GEII")
+    lines.append(f"Cordialement,\nService {DEPARTEMENT['expediteur']}")
 
     return "\n".join(lines)
 
+def recapitulatif_email(user_code):
+    # Récapitulatif de la saisie de la session (arguments de SendSmtpEmail), None sans adresse
+    destinataire = st.session_state.email_utilisateur
+    if not destinataire:
+        return None
+    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    ponc = ponctuels_avec_regles(st.session_state.ponctuels, st.session_state.regles.values())
+    return contenu_email(
+        destinataire, f"Récapitulatif des indisponibilités - {now}",
+        generer_contenu_email(user_code, ponc, st.session_state.commentaire, now)
+    )
+
+# ======================
+# ENREGISTREMENT GROUPÉ (SUPABASE)
+# ======================
+TAILLE_LOT_INSERT = 500
+
+def etat_rpc(departement=None):
+    # Partagé entre sessions : évite de retenter une RPC absente à chaque enregistrement
+    return etat_departement(
+        "rpc", {"remplacer_indisponibilites": True, "appliquer_diff_indisponibilites": True, "archiver_lot": True},
+        departement
+    )
+
+def construire_lignes_datas(enseignant_id, user_code, items, commentaire, champ=None):
+    # items : couples ((semaine, jour, creneau), {"raison": ...}) ; champ : campagne
+    # imposée (rejeu du journal), sinon la campagne active
+    return [
+        {
+            "enseignant_id": enseignant_id,
+            "semaine": int(semaine or 0),
+            "jour": jour,
+            "creneau": creneau,
+            "code_creneau": f"{jour}_{creneau}",
+            "code_streamlit": code_streamlit(user_code, (semaine, jour, creneau)),
+            "raisons": p.get("raison", ""),
+            "commentaires_global": commentaire,
+            **(champ_campagne() if champ is None else champ)
+        }
+        for (semaine, jour, creneau), p in items
+    ]
+
+def enregistrer_indisponibilites(enseignant_id, user_code, ponctuels, commentaire, regles=()):
+    if etat_regles()["disponible"]:
+        remplacer_regles(enseignant_id, list(regles))
+    else:
+        ponctuels = ponctuels_avec_regles(ponctuels, regles)
+    lignes = construire_lignes_datas(enseignant_id, user_code, ponctuels.items(), commentaire)
+    rpc = etat_rpc()
+
+    # 1 seul aller-retour, dans une transaction (voir sql/remplacer_indisponibilites.sql)
+    if rpc["remplacer_indisponibilites"]:
+        try:
+            client_supabase().rpc("remplacer_indisponibilites", {
+                "p_enseignant_id": enseignant_id,
+                "p_lignes": lignes,
+                "p_campagne_id": champ_campagne().get("campagne_id")
+            }).execute()
+            return
+        except Exception as e:
+            if not erreur_fonction_absente(e):
+                raise
+            rpc["remplacer_indisponibilites"] = False
+
+    # Repli sans RPC : suppression puis insertion par lots
+    filtre_campagne(client_supabase().table("datas").delete().eq("enseignant_id", enseignant_id)).execute()
+    for i in range(0, len(lignes), TAILLE_LOT_INSERT):
+        client_supabase().table("datas").insert(lignes[i:i + TAILLE_LOT_INSERT]).execute()
+
+# ======================
+# CACHE ANNUAIRE ET DONNÉES ENSEIGNANT
+# ======================
+TTL_ANNUAIRE = 600  # secondes
+COLONNES_DATAS = "id,semaine,jour,creneau,code_streamlit,raisons,commentaires_global,timestamp"
+
+@st.cache_data(ttl=TTL_ANNUAIRE, show_spinner=False)
+def charger_annuaire(departement):
+    # Partagé par les sessions du département ; code -> id et libellés tirés du même résultat
+    enseignants = client_supabase().table("enseignants").select("id,code,nom,prenom").order("code").execute().data
+    return {
+        "enseignants": enseignants,
+        "id_par_code": {e["code"].strip().upper(): e["id"] for e in enseignants},
+        "libelles": {e["id"]: f"{e['code']} – {e['nom']} {e['prenom']}" for e in enseignants}
+    }
+
+def generation_datas():
+    # Incrémentée par l'effacement admin : invalide les caches de toutes les sessions
+    return etat_departement("generation", {"valeur": 0})
+
+def lire_datas_enseignant(enseignant_id, forcer=False):
+    # Cache par session, invalidé par l'enregistrement de l'enseignant ou l'effacement admin
+    cache = st.session_state.setdefault("cache_datas", {})
+    generation = generation_datas()["valeur"]
+    if forcer or cache.get(enseignant_id, (None,))[0] != generation:
+        rows = (
+            filtre_campagne(client_supabase().table("datas").select(COLONNES_DATAS))
+            .eq("enseignant_id", enseignant_id).order("id").execute().data
+        )
+        cache[enseignant_id] = (generation, rows)
+    return cache[enseignant_id][1]
+
+def parcourir_regles(filtre=None, table="regles"):
+    etat = etat_regles()
+    if not etat["disponible"]:
+        return
+    try:
+        yield from parcourir_table(table, COLONNES_REGLES, filtre)
+    except Exception as e:
+        if not erreur_table_absente(e):
+            raise
+        etat["disponible"] = False
+
+def lire_regles_enseignant(enseignant_id, forcer=False):
+    cache = st.session_state.setdefault("cache_regles", {})
+    generation = generation_datas()["valeur"]
+    if forcer or cache.get(enseignant_id, (None,))[0] != generation:
+        rows = [r for page in parcourir_regles(lambda q: filtre_campagne(q.eq("enseignant_id", enseignant_id))) for r in page]
+        cache[enseignant_id] = (generation, rows)
+    return cache[enseignant_id][1]
+
+# ======================
+# CAMPAGNES
+# ======================
+# Une campagne (ex. "2026 S1 impairs") regroupe les saisies d'une période. Seule la
+# campagne active est dans datas / regles ; à sa clôture, ses lignes sont déplacées
+# par lots dans datas_archive / regles_archive (voir sql/campagnes.sql).
+TAILLE_LOT_ARCHIVE = 5000  # lignes déplacées par appel à la RPC archiver_lot
+TABLES_ARCHIVEES = ("datas", "regles")
+
+def etat_campagnes():
+    # Partagé entre sessions : table campagnes absente -> fonctionnement sans campagne
+    return etat_departement("campagnes", {"disponible": True})
+
+@st.cache_data(ttl=TTL_ANNUAIRE, show_spinner=False)
+def campagne_active(departement):
+    if not etat_campagnes()["disponible"]:
+        return None
+    try:
+        lignes = (
+            client_supabase().table("campagnes").select("id,nom,semestre_filter,creee_le")
+            .eq("statut", "active").order("id", desc=True).limit(1).execute().data
+        )
+    except Exception as e:
+        if not erreur_table_absente(e):
+            raise
+        etat_campagnes()["disponible"] = False
+        return None
+    return lignes[0] if lignes else None
+
+def campagne_ouverte(client, campagne_id):
+    # Rejeu du journal : une saisie dont la campagne a été clôturée depuis ne doit pas
+    # revenir dans datas (lignes ignorées par les lectures et jamais archivées)
+    lignes = client.table("campagnes").select("statut").eq("id", campagne_id).execute().data
+    return bool(lignes) and lignes[0]["statut"] == "active"
+
+def champ_campagne():
+    campagne = campagne_active(DEPARTEMENT["code"])
+    return {"campagne_id": campagne["id"]} if campagne else {}
+
+def filtre_campagne(requete, champ=None):
+    # Toutes les lectures / écritures utilisateur portent sur la campagne active (index campagne_id)
+    champ = champ_campagne() if champ is None else champ
+    return requete.eq("campagne_id", champ["campagne_id"]) if champ else requete
+
+def tables_archivees():
+    return [t for t in TABLES_ARCHIVEES if t != "regles" or etat_regles()["disponible"]]
+
+def lister_campagnes():
+    return (
+        client_supabase().table("campagnes").select("id,nom,semestre_filter,statut,creee_le,archivee_le")
+        .order("id", desc=True).execute().data
+    )
+
+def ouvrir_campagne(nom, semestre):
+    campagne = client_supabase().table("campagnes").insert(
+        {"nom": nom, "semestre_filter": semestre, "statut": "active"}
+    ).execute().data[0]
+    # Saisies antérieures à la première campagne : rattachées à celle-ci
+    for table in tables_archivees():
+        client_supabase().table(table).update({"campagne_id": campagne["id"]}).is_("campagne_id", "null").execute()
+    campagne_active.clear(DEPARTEMENT["code"])
+    return campagne
+
+def archiver_lot(table, campagne_id):
+    # Déplace un lot de lignes vers <table>_archive ; 0 quand il ne reste rien
+    rpc = etat_rpc()
+    if rpc["archiver_lot"]:
+        try:
+            return client_supabase().rpc("archiver_lot", {
+                "p_table": table,
+                "p_campagne_id": campagne_id,
+                "p_taille": TAILLE_LOT_ARCHIVE
+            }).execute().data or 0
+        except Exception as e:
+            if not erreur_fonction_absente(e):
+                raise
+            rpc["archiver_lot"] = False
+
+    # Repli sans RPC : copie (upsert, rejouable) puis suppression, une page à la fois
+    lot = (
+        client_supabase().table(table).select("*").eq("campagne_id", campagne_id)
+        .order("id").limit(TAILLE_PAGE).execute().data
+    )
+    if lot:
+        client_supabase().table(f"{table}_archive").upsert(lot).execute()
+        ids = [r["id"] for r in lot]
+        for i in range(0, len(ids), TAILLE_LOT_SUPPRESSION):
+            client_supabase().table(table).delete().in_("id", ids[i:i + TAILLE_LOT_SUPPRESSION]).execute()
+    return len(lot)
+
+def cloturer_campagne(campagne, progression=None):
+    deplaces = 0
+    for table in tables_archivees():
+        while True:
+            n = archiver_lot(table, campagne["id"])
+            if not n:
+                break
+            deplaces += n
+            if progression:
+                progression(deplaces)
+    client_supabase().table("campagnes").update(
+        {"statut": "archivee", "archivee_le": datetime.now().isoformat()}
+    ).eq("id", campagne["id"]).execute()
+    campagne_active.clear(DEPARTEMENT["code"])
+    return deplaces
+
+@st.cache_data(max_entries=8, show_spinner="Chargement de la campagne archivée…")
+def charger_campagne_archivee(departement, campagne_id):
+    import pandas as pd
+
+    # Une campagne archivée ne change plus : pas de version à suivre
+    colonnes = ["enseignant_id", "semaine", "jour", "creneau"]
+    filtre = lambda q: q.eq("campagne_id", campagne_id)
+    pages = [pd.DataFrame(page) for page in parcourir_table("datas_archive", ",".join(["id"] + colonnes), filtre)]
+    pages += [pd.DataFrame(page) for page in pages_regles_developpees(filtre, "regles_archive") if page]
+    if not pages:
+        return pd.DataFrame(columns=colonnes)
+    df = pd.concat(pages, ignore_index=True)[colonnes]
+    df["semaine"] = df["semaine"].astype(str)
+    return df.drop_duplicates(ignore_index=True)
+
+# ======================
+# SYNCHRONISATION DIFFÉRENTIELLE
+# ======================
+TAILLE_LOT_SUPPRESSION = 200  # ids passés dans l'URL (filtre in.)
+
+def version_donnees(rows):
+    # Signature légère des lignes serveur : détecte un enregistrement concurrent (autre onglet)
+    if not rows:
+        return (0, "", 0)
+    return (len(rows), max(str(r.get("timestamp") or "") for r in rows), max(r["id"] for r in rows))
+
+def etat_serveur(user_rows):
+    # (créneaux -> id et raison, ids à supprimer, commentaire) des lignes datas d'un enseignant
+    snapshot = {}
+    orphelins = []
+    for r in user_rows:
+        key = cle_creneau(r.get("semaine"), r.get("jour"), r.get("creneau"))
+        if (r.get("code_streamlit") or "").endswith("_I") and key not in snapshot:
+            snapshot[key] = {"id": r["id"], "raison": r.get("raisons", "")}
+        else:
+            # doublons ou lignes hors format : supprimées au prochain enregistrement
+            orphelins.append(r["id"])
+    commentaire = (user_rows[-1].get("commentaires_global") or "") if user_rows else ""
+    return snapshot, orphelins, commentaire
+
+def charger_snapshot(user_rows, regles_rows=()):
+    snapshot, orphelins, commentaire = etat_serveur(user_rows)
+    st.session_state.snapshot = snapshot
+    st.session_state.snapshot_orphelins = orphelins
+    st.session_state.snapshot_regles = {r["id"]: ligne_regle(None, r) for r in regles_rows}
+    st.session_state.snapshot_version = (version_donnees(user_rows), version_donnees(regles_rows))
+    st.session_state.snapshot_commentaire = commentaire
+    return snapshot
+
+def calculer_diff(snapshot, orphelins, ponctuels):
+    suppressions = list(orphelins) + [v["id"] for k, v in snapshot.items() if k not in ponctuels]
+    ajouts = [(k, p) for k, p in ponctuels.items() if k not in snapshot]
+    modifications = [
+        (snapshot[k]["id"], (k, p)) for k, p in ponctuels.items()
+        if k in snapshot and (p.get("raison") or "") != (snapshot[k]["raison"] or "")
+    ]
+    return suppressions, ajouts, modifications
+
+def ligne_regle(enseignant_id, regle):
+    return {
+        "enseignant_id": enseignant_id,
+        "semaines": [str(c) for c in regle["semaines"]],
+        "jours": list(regle["jours"]),
+        "creneaux": list(regle["creneaux"]),
+        "raison": regle.get("raison") or "",
+        "exceptions": sorted(list(e) for e in regle.get("exceptions") or [])
+    }
+
+def synchroniser_regles(enseignant_id, regles):
+    # Peu de lignes (une par règle) : delta en 3 requêtes au plus, hors transaction des datas
+    avant = st.session_state.snapshot_regles
+    gardees = {r["id"] for r in regles if r["id"] is not None}
+    suppressions = [i for i in avant if i not in gardees]
+    ajouts = [dict(ligne_regle(enseignant_id, r), **champ_campagne()) for r in regles if r["id"] is None]
+    modifications = [
+        dict(ligne_regle(enseignant_id, r), id=r["id"], timestamp=datetime.now().isoformat(), **champ_campagne())
+        for r in regles if r["id"] is not None and ligne_regle(None, r) != avant.get(r["id"])
+    ]
+    if suppressions:
+        client_supabase().table("regles").delete().in_("id", suppressions).execute()
+    if ajouts:
+        client_supabase().table("regles").insert(ajouts).execute()
+    if modifications:
+        client_supabase().table("regles").upsert(modifications).execute()
+
+def remplacer_regles(enseignant_id, regles):
+    filtre_campagne(client_supabase().table("regles").delete().eq("enseignant_id", enseignant_id)).execute()
+    if regles:
+        client_supabase().table("regles").insert([dict(ligne_regle(enseignant_id, r), **champ_campagne()) for r in regles]).execute()
+
+def donnees_modifiees_ailleurs(enseignant_id):
+    # Vrai si les données serveur ont changé depuis leur chargement (autre onglet ou appareil)
+    serveur = filtre_campagne(client_supabase().table("datas").select("id,timestamp")).eq("enseignant_id", enseignant_id).execute().data
+    if etat_regles()["disponible"]:
+        serveur_regles = [r for page in parcourir_regles(lambda q: filtre_campagne(q.eq("enseignant_id", enseignant_id))) for r in page]
+    else:
+        serveur_regles = []
+    return (version_donnees(serveur), version_donnees(serveur_regles)) != st.session_state.snapshot_version
+
+def appliquer_diff(client, enseignant_id, user_code, diff, commentaire, commentaire_modifie, champ=None, departement=None):
+    suppressions, ajouts, modifications = diff
+    if not (suppressions or ajouts or modifications or commentaire_modifie):
+        return
+
+    now = datetime.now().isoformat()
+    lignes_ajouts = construire_lignes_datas(enseignant_id, user_code, ajouts, commentaire, champ)
+    lignes_modifs = [
+        dict(ligne, id=id_serveur, timestamp=now)
+        for (id_serveur, _), ligne in zip(
+            modifications,
+            construire_lignes_datas(enseignant_id, user_code, [item for _, item in modifications], commentaire, champ)
+        )
+    ]
+    rpc = etat_rpc(departement)
+
+    # 1 seul aller-retour, dans une transaction (voir sql/appliquer_diff_indisponibilites.sql)
+    if rpc["appliquer_diff_indisponibilites"]:
+        try:
+            client.rpc("appliquer_diff_indisponibilites", {
+                "p_enseignant_id": enseignant_id,
+                "p_suppressions": suppressions,
+                "p_ajouts": lignes_ajouts,
+                "p_modifications": lignes_modifs,
+                "p_commentaire": commentaire if commentaire_modifie else None,
+                "p_campagne_id": (champ_campagne() if champ is None else champ).get("campagne_id")
+            }).execute()
+            return
+        except Exception as e:
+            if not erreur_fonction_absente(e):
+                raise
+            rpc["appliquer_diff_indisponibilites"] = False
+
+    # Repli sans RPC : uniquement le delta, par lots
+    for i in range(0, len(suppressions), TAILLE_LOT_SUPPRESSION):
+        client.table("datas").delete().in_("id", suppressions[i:i + TAILLE_LOT_SUPPRESSION]).execute()
+    for i in range(0, len(lignes_ajouts), TAILLE_LOT_INSERT):
+        client.table("datas").insert(lignes_ajouts[i:i + TAILLE_LOT_INSERT]).execute()
+    for i in range(0, len(lignes_modifs), TAILLE_LOT_INSERT):
+        client.table("datas").upsert(lignes_modifs[i:i + TAILLE_LOT_INSERT]).execute()
+    if commentaire_modifie:
+        filtre_campagne(client.table("datas").update({
+            "commentaires_global": commentaire,
+            "timestamp": now
+        }).eq("enseignant_id", enseignant_id), champ).execute()
+
+def synchroniser_indisponibilites(enseignant_id, user_code, ponctuels, commentaire, regles=()):
+    # Retourne False si les données serveur ont changé depuis leur chargement
+    if donnees_modifiees_ailleurs(enseignant_id):
+        return False
+
+    if etat_regles()["disponible"]:
+        synchroniser_regles(enseignant_id, list(regles))
+    else:
+        # Sans table regles : les règles sont enregistrées développées, comme des créneaux
+        ponctuels = ponctuels_avec_regles(ponctuels, regles)
+
+    diff = calculer_diff(st.session_state.snapshot, st.session_state.snapshot_orphelins, ponctuels)
+    commentaire_modifie = (commentaire or "") != st.session_state.snapshot_commentaire
+    appliquer_diff(client_supabase(), enseignant_id, user_code, diff, commentaire, commentaire_modifie)
+    return True
+
+# ======================
+# JOURNAL LOCAL DES ENREGISTREMENTS (SQLITE)
+# ======================
+# Un enregistrement est d'abord écrit dans un journal SQLite sur disque (mode WAL),
+# ce qui suffit à le confirmer ; un thread unique (partagé entre sessions) le rejoue
+# ensuite vers Supabase, dans l'ordre, en réessayant tant que Supabase ne répond pas.
+# Chaque entrée contient l'état complet voulu (créneaux, règles, commentaire) : le
+# rejeu relit l'état serveur et n'écrit que l'écart, il peut donc être répété sans
+# effet de bord, et seule la dernière entrée d'une session est rejouée.
+# L'entrée garde aussi la version serveur sur laquelle la saisie a été faite : si le
+# serveur a changé entre-temps (autre onglet ou appareil), ou si sa campagne a été
+# clôturée, elle passe au statut « conflit » au lieu d'écraser, et la session propose
+# de recharger ou d'écraser. Le récapitulatif par email n'est envoyé qu'après l'écriture.
+FICHIER_JOURNAL = os.path.join(tempfile.gettempdir(), "indisponibilites_journal.sqlite3")
+DELAI_MAX_REJEU = 60  # secondes entre deux essais quand Supabase est injoignable
+MAX_RESULTATS_JOURNAL = 1000  # entrées rejouées dont le résultat attend sa session
+CONFLIT_MODIFIEE = "modifiées ailleurs depuis le chargement"
+CONFLIT_CAMPAGNE = "campagne clôturée avant l'envoi"
+
+def connexion_journal(chemin):
+    connexion = sqlite3.connect(chemin, timeout=10)
+    connexion.execute("pragma journal_mode=wal")
+    connexion.execute("pragma synchronous=full")  # entrée sur disque avant la confirmation
+    return connexion
+
+def lire_journal(etat, requete, parametres=()):
+    with closing(connexion_journal(etat["chemin"])) as connexion:
+        return connexion.execute(requete, parametres).fetchall()
+
+def ecrire_journal(etat, requete, parametres=()):
+    with closing(connexion_journal(etat["chemin"])) as connexion, connexion:
+        return connexion.execute(requete, parametres).lastrowid
+
+def rejouer_regles(client, regles_serveur, enseignant_id, regles, champ):
+    # Comparaison par contenu : les règles déjà présentes sur le serveur sont gardées
+    restantes = [json.dumps(ligne_regle(None, r), sort_keys=True) for r in regles]
+    suppressions = []
+    for r in regles_serveur:
+        contenu = json.dumps(ligne_regle(None, r), sort_keys=True)
+        if contenu in restantes:
+            restantes.remove(contenu)
+        else:
+            suppressions.append(r["id"])
+    for i in range(0, len(suppressions), TAILLE_LOT_SUPPRESSION):
+        client.table("regles").delete().in_("id", suppressions[i:i + TAILLE_LOT_SUPPRESSION]).execute()
+    if restantes:
+        client.table("regles").insert(
+            [dict(json.loads(c), enseignant_id=enseignant_id, **champ) for c in restantes]
+        ).execute()
+
+def version_journal(version):
+    # snapshot_version sous forme JSON (listes), telle que stockée dans une entrée
+    return [list(v) for v in version] if version is not None else None
+
+def version_serveur(client, filtre, avec_regles):
+    # Même signature que snapshot_version (voir charger_snapshot), relue sur le serveur
+    lire = lambda table: [r for page in parcourir_table(table, "id,timestamp", filtre, client) for r in page]
+    return (version_donnees(lire("datas")), version_donnees(lire("regles") if avec_regles else []))
+
+def rejouer_sauvegarde(client, sauvegarde, attendue=None):
+    # Renvoie la version serveur après écriture, ou None si le serveur a changé depuis
+    # le chargement de la saisie (attendue) : conflit, rien n'est écrit
+    enseignant_id = sauvegarde["enseignant_id"]
+    departement = sauvegarde.get("departement")
+    champ = {"campagne_id": sauvegarde["campagne_id"]} if sauvegarde["campagne_id"] is not None else {}
+    filtre = lambda q: filtre_campagne(q.eq("enseignant_id", enseignant_id), champ)
+    avec_regles = sauvegarde["regles"] is not None
+
+    regles_serveur = [r for page in parcourir_table("regles", COLONNES_REGLES, filtre, client) for r in page] if avec_regles else []
+    serveur = [r for page in parcourir_table("datas", COLONNES_DATAS, filtre, client) for r in page]
+    if attendue is not None and version_journal((version_donnees(serveur), version_donnees(regles_serveur))) != attendue:
+        return None
+
+    if avec_regles:
+        rejouer_regles(client, regles_serveur, enseignant_id, sauvegarde["regles"], champ)
+    snapshot, orphelins, commentaire_serveur = etat_serveur(serveur)
+    ponctuels = {cle_creneau(*p[:3]): {"raison": p[3]} for p in sauvegarde["ponctuels"]}
+    commentaire = sauvegarde["commentaire"]
+    appliquer_diff(
+        client, enseignant_id, sauvegarde["user_code"], calculer_diff(snapshot, orphelins, ponctuels),
+        commentaire, (commentaire or "") != commentaire_serveur, champ, departement
+    )
+    return version_serveur(client, filtre, avec_regles)
+
+def noter_resultat(etat, id_entree, version, conflit=""):
+    # Lu par les sessions qui suivent l'entrée (suivre_sauvegarde_session) ; conflit : motif
+    resultats = etat["resultats"]
+    resultats[id_entree] = {"version": version, "conflit": conflit}
+    while len(resultats) > MAX_RESULTATS_JOURNAL:
+        resultats.pop(next(iter(resultats)))  # sessions fermées avant le rejeu
+
+def chaines_journal(entrees):
+    # Entrées d'une même session reliées par « precedente » : seule la dernière est écrite.
+    # Les saisies d'autres onglets forment leur propre chaîne, rejouée à son tour (ordre
+    # de la première entrée) et contrôlée contre sa propre version.
+    suivantes = {}
+    for id_entree, (departement, enseignant_id, sauvegarde) in entrees.items():
+        precedente = entrees.get(sauvegarde.get("precedente"))
+        if precedente and precedente[:2] == (departement, enseignant_id):
+            suivantes[sauvegarde["precedente"]] = id_entree
+    chaines = []
+    remplacees = set(suivantes.values())
+    for id_entree in entrees:
+        if id_entree in remplacees:
+            continue
+        chaine = [id_entree]
+        while chaine[-1] in suivantes:
+            chaine.append(suivantes[chaine[-1]])
+        chaines.append(chaine)
+    return chaines
+
+def rejouer_journal(etat):
+    # Renvoie False si une entrée n'a pas pu être rejouée (nouvel essai plus tard)
+    requete = "select id, departement, enseignant_id, contenu from sauvegardes where statut = 'en_attente' order by id"
+    entrees = {
+        id_entree: (departement, enseignant_id, json.loads(contenu))
+        for id_entree, departement, enseignant_id, contenu in lire_journal(etat, requete)
+    }
+    complet = True
+    bloques = set()  # enseignants dont une entrée plus ancienne reste à rejouer
+    for chaine in chaines_journal(entrees):
+        id_entree = chaine[-1]
+        departement, enseignant_id, sauvegarde = entrees[id_entree]
+        if (departement, enseignant_id) in bloques:
+            continue
+        # version serveur sur laquelle la saisie a été faite : celle laissée par le rejeu
+        # de l'entrée précédente de la même session si elle a eu lieu entre-temps
+        attendue = sauvegarde.get("version")
+        precedente = etat["resultats"].get(entrees[chaine[0]][2].get("precedente"))
+        if attendue is not None and precedente and not precedente["conflit"]:
+            attendue = version_journal(precedente["version"])
+        # client du schéma du département, sur le pool HTTP partagé
+        supabase = instrumenter_supabase(client_schema(sauvegarde.get("schema", "public")), etat["journal"], CONTEXTE_JOURNAL)
+        try:
+            if sauvegarde["campagne_id"] is not None and not campagne_ouverte(supabase, sauvegarde["campagne_id"]):
+                version, conflit = None, CONFLIT_CAMPAGNE
+            else:
+                version = rejouer_sauvegarde(supabase, sauvegarde, attendue)
+                conflit = CONFLIT_MODIFIEE if version is None else ""
+        except Exception as e:
+            complet = False
+            bloques.add((departement, enseignant_id))
+            ecrire_journal(
+                etat, "update sauvegardes set tentatives = tentatives + 1, erreur = ? where id = ?", (str(e), id_entree)
+            )
+            continue
+        # entrées remplacées par la dernière de la session ; en conflit, celle-ci est gardée
+        # (statut conflit) jusqu'au choix de l'enseignant et aucun récapitulatif n'est envoyé
+        retirees = chaine[:-1] if conflit else chaine
+        ecrire_journal(etat, f"delete from sauvegardes where id in ({','.join('?' * len(retirees))})", retirees)
+        if conflit:
+            ecrire_journal(
+                etat, "update sauvegardes set statut = 'conflit', erreur = ? where id = ?", (conflit, id_entree)
+            )
+        else:
+            cache_masques(departement or None).pop(enseignant_id, None)
+            if sauvegarde.get("email") and etat.get("boite_envoi"):
+                planifier_email(etat["boite_envoi"], nouveau_message(
+                    sauvegarde["email"]["to"][0]["email"], sauvegarde["email"], sauvegarde.get("schema", "public")
+                ))
+        for id_chaine in chaine:
+            noter_resultat(etat, id_chaine, version, conflit)
+    return complet
+
+def vider_journal(etat):
+    echecs = 0
+    while True:
+        etat["reveil"].wait(min(DELAI_MAX_REJEU, DELAI_BASE_ESSAI * 2 ** (echecs - 1)) if echecs else None)
+        etat["reveil"].clear()
+        try:
+            complet = rejouer_journal(etat)
+        except sqlite3.Error:
+            complet = False  # fichier verrouillé : le thread ne doit jamais s'arrêter
+        echecs = 0 if complet else echecs + 1
+
+@st.cache_resource
+def journal_sauvegardes():
+    # None si le fichier ne peut pas être créé : enregistrement direct dans Supabase
+    chemin = st.secrets.get("JOURNAL_SAUVEGARDES", FICHIER_JOURNAL)
+    etat = {"chemin": chemin, "reveil": threading.Event(), "journal": journal_appels(), "resultats": {}}
+    try:
+        ecrire_journal(etat, """
+            create table if not exists sauvegardes (
+                id integer primary key autoincrement,
+                departement text not null default '',
+                enseignant_id integer not null,
+                contenu text not null,
+                cree_le text not null,
+                tentatives integer not null default 0,
+                erreur text not null default '',
+                statut text not null default 'en_attente'
+            )
+        """)
+        colonnes = [c[1] for c in lire_journal(etat, "pragma table_info(sauvegardes)")]
+        if "departement" not in colonnes:
+            # journal créé avant les départements : ses entrées sont celles du département par défaut
+            ecrire_journal(etat, "alter table sauvegardes add column departement text not null default ''")
+        if "statut" not in colonnes:
+            ecrire_journal(etat, "alter table sauvegardes add column statut text not null default 'en_attente'")
+    except sqlite3.Error as e:
+        LOGGER.warning("[journal] %s indisponible, enregistrement direct : %s", chemin, e)
+        return None
+    if lire_journal(etat, "select 1 from sauvegardes where statut = 'en_attente' limit 1"):
+        etat["boite_envoi"] = boite_envoi()  # récapitulatifs des entrées laissées par un arrêt précédent
+    etat["reveil"].set()  # entrées laissées par un arrêt précédent
+    threading.Thread(
+        target=vider_journal, args=(etat,), daemon=True, name="journal-sauvegardes"
+    ).start()
+    return etat
+
+def journaliser_sauvegarde(etat, enseignant_id, user_code, forcer=False):
+    # forcer : « Écraser avec ma saisie », rejouée quel que soit l'état du serveur
+    regles = list(st.session_state.regles.values())
+    ponctuels = st.session_state.ponctuels
+    if not etat_regles()["disponible"]:
+        # Sans table regles : les règles sont enregistrées développées, comme des créneaux
+        ponctuels, regles = ponctuels_avec_regles(ponctuels, regles), None
+    sauvegarde = {
+        "departement": DEPARTEMENT["code"],
+        "schema": DEPARTEMENT["schema"],
+        "enseignant_id": enseignant_id,
+        "user_code": user_code,
+        "campagne_id": champ_campagne().get("campagne_id"),
+        "ponctuels": [[*cle, p.get("raison") or ""] for cle, p in ponctuels.items()],
+        "regles": regles,
+        "commentaire": st.session_state.commentaire,
+        # contrôle de conflit fait au rejeu (voir rejouer_journal)
+        "version": None if forcer else version_journal(st.session_state.snapshot_version),
+        "precedente": st.session_state.get("_sauvegarde_journal"),
+        "email": recapitulatif_email(user_code)  # mis en file par le rejeu, après l'écriture
+    }
+    if sauvegarde["email"]:
+        etat["boite_envoi"] = boite_envoi()
+    st.session_state._sauvegarde_journal = ecrire_journal(
+        etat, "insert into sauvegardes (departement, enseignant_id, contenu, cree_le) values (?, ?, ?, ?)",
+        (DEPARTEMENT["code"], enseignant_id, json.dumps(sauvegarde, ensure_ascii=False), datetime.now().isoformat(timespec="seconds"))
+    )
+    etat["reveil"].set()
+
+def sauvegarde_en_attente(etat, enseignant_id):
+    # (id, statut, motif du conflit, saisie) de la dernière entrée de l'enseignant, ou None
+    lignes = lire_journal(
+        etat,
+        "select id, statut, erreur, contenu from sauvegardes where departement = ? and enseignant_id = ? order by id desc limit 1",
+        (DEPARTEMENT["code"], enseignant_id)
+    )
+    return (*lignes[0][:3], json.loads(lignes[0][3])) if lignes else None
+
+def charger_sauvegarde_session(id_entree, statut, erreur, sauvegarde):
+    # Saisie pas encore rejouée (ou en conflit) : elle prime sur l'état serveur
+    st.session_state.ponctuels = {cle_creneau(*p[:3]): {"raison": p[3]} for p in sauvegarde["ponctuels"]}
+    installer_regles_session({
+        f"r{r['id']}" if r["id"] is not None else f"n{uuid.uuid4().hex[:8]}": r
+        for r in sauvegarde["regles"] or []
+    })
+    if sauvegarde.get("version") is not None:
+        # version serveur sur laquelle la saisie a été faite (contrôle au rejeu)
+        st.session_state.snapshot_version = tuple(tuple(v) for v in sauvegarde["version"])
+    if statut == "conflit":
+        st.session_state._conflit_sauvegarde = erreur or CONFLIT_MODIFIEE
+    else:
+        st.session_state._sauvegarde_journal = id_entree
+
+def suivre_sauvegarde_session(etat, enseignant_id):
+    # Entrée de la session rejouée : snapshot rechargé, à la version relevée juste après
+    # l'écriture (une modification faite ailleurs ensuite reste détectée)
+    # (lecture sans retrait : une autre session du même enseignant peut suivre la même entrée)
+    resultat = etat["resultats"].get(st.session_state.get("_sauvegarde_journal"))
+    if resultat is None:
+        return
+    st.session_state._sauvegarde_journal = None
+    if resultat["conflit"]:
+        st.session_state._conflit_sauvegarde = resultat["conflit"]
+        if resultat["conflit"] == CONFLIT_CAMPAGNE:
+            campagne_active.clear(DEPARTEMENT["code"])  # la session relit la campagne active
+        return
+    regles_rows = lire_regles_enseignant(enseignant_id, forcer=True)
+    charger_snapshot(lire_datas_enseignant(enseignant_id, forcer=True), regles_rows)
+    st.session_state.snapshot_version = resultat["version"]
+    st.session_state._commentaire_en_attente = None
+
+def abandonner_sauvegarde(etat, enseignant_id):
+    # « Recharger » ou « Écraser » : saisies en conflit ou en attente de la session abandonnées
+    ecrire_journal(
+        etat, "delete from sauvegardes where departement = ? and enseignant_id = ? and (statut = 'conflit' or id = ?)",
+        (DEPARTEMENT["code"], enseignant_id, st.session_state.get("_sauvegarde_journal"))
+    )
+    st.session_state._sauvegarde_journal = None
+
+# ======================
+# LECTURE PAGINÉE ET AGRÉGATS (ADMIN)
+# ======================
+TAILLE_PAGE = 1000  # limite par défaut d'une requête Supabase
+
+def parcourir_table(table, colonnes, filtre=None, client=None):
+    # Pagination par clé (id > dernier id vu) : coût constant par page, sans OFFSET
+    dernier_id = None
+    while True:
+        requete = (client or client_supabase()).table(table).select(colonnes).order("id").limit(TAILLE_PAGE)
+        if filtre:
+            requete = filtre(requete)
+        if dernier_id is not None:
+            requete = requete.gt("id", dernier_id)
+        page = requete.execute().data
+        if page:
+            yield page
+        if len(page) < TAILLE_PAGE:
+            return
+        dernier_id = page[-1]["id"]
+
+def version_table(table):
+    # Nombre de lignes + dernière modification : 1 requête d'une ligne
+    resp = (
+        client_supabase().table(table).select("timestamp", count="exact")
+        .order("timestamp", desc=True, nullsfirst=False).limit(1).execute()
+    )
+    return (resp.count or 0, str(resp.data[0].get("timestamp")) if resp.data else "")
+
+def version_indisponibilites():
+    version = (DEPARTEMENT["code"], (campagne_active(DEPARTEMENT["code"]) or {}).get("id")) + version_table("datas")
+    if etat_regles()["disponible"]:
+        try:
+            version += version_table("regles")
+        except Exception as e:
+            if not erreur_table_absente(e):
+                raise
+            etat_regles()["disponible"] = False
+    return version
+
+def pages_regles_developpees(filtre=None, table="regles"):
+    # Règles développées en lignes (enseignant_id, semaine, jour, creneau, raison, regle_id)
+    for page in parcourir_regles(filtre, table):
+        lignes = []
+        for r in page:
+            regle = regle_depuis_ligne(r)
+            lignes.extend(
+                {"enseignant_id": r["enseignant_id"], "semaine": s, "jour": j, "creneau": c,
+                 "raisons": regle["raison"], "regle_id": r["id"], "timestamp": r.get("timestamp")}
+                for s, j, c in cles_regle(regle)
+            )
+        yield lignes
+
+@st.cache_data(max_entries=2 * len(DEPARTEMENTS), show_spinner="Chargement de toutes les indisponibilités…")
+def charger_toutes_indisponibilites(version):
+    import pandas as pd
+
+    # version : uniquement pour invalider le cache quand la table change
+    colonnes = ["enseignant_id", "semaine", "jour", "creneau"]
+    pages = [pd.DataFrame(page) for page in parcourir_table("datas", ",".join(["id"] + colonnes), filtre_campagne)]
+    pages += [pd.DataFrame(page) for page in pages_regles_developpees(filtre_campagne) if page]
+    if not pages:
+        return pd.DataFrame(columns=colonnes)
+    df = pd.concat(pages, ignore_index=True)[colonnes]
+    df["semaine"] = df["semaine"].astype(str)
+    return df.drop_duplicates(ignore_index=True)
+
+def compter_par_cellule(df):
+    # Nombre d'enseignants indisponibles par cellule semaines x jours x créneaux
+    comptes = np.zeros(FORME_GRILLE, dtype=np.int32)
+    indices = [df[col].map(INDEX[axe]["positions"]) for col, axe in zip(("semaine", "jour", "creneau"), AXES_GRILLE)]
+    connus = indices[0].notna() & indices[1].notna() & indices[2].notna()
+    np.add.at(comptes, tuple(i[connus].astype(int).to_numpy() for i in indices), 1)
+    return comptes
+
+def carte_chaleur(comptes, semaines_visibles):
+    import pandas as pd
+    import altair as alt
+
+    codes = [INDEX[axe]["codes"] for axe in AXES_GRILLE]
+    i, j, k = np.indices(FORME_GRILLE).reshape(3, -1)
+    jours = np.array([CODE_TO_JOUR.get(c, c) for c in codes[1]])
+    creneaux = np.array([CODE_TO_CREN.get(c, c) for c in codes[2]])
+    df = pd.DataFrame({
+        "Semaine": np.array(codes[0])[i],
+        "Jour / créneau": jours[j] + " · " + creneaux[k],
+        "Enseignants": comptes.ravel()
+    })
+    df = df[df["Semaine"].isin(semaines_visibles)]
+    ordre_colonnes = list(dict.fromkeys(df["Jour / créneau"]))
+    return alt.Chart(df).mark_rect().encode(
+        x=alt.X("Jour / créneau:N", sort=ordre_colonnes),
+        y=alt.Y("Semaine:N", sort=[c for c in codes[0] if c in semaines_visibles]),
+        color=alt.Color("Enseignants:Q", scale=alt.Scale(scheme="orangered")),
+        tooltip=["Semaine", "Jour / créneau", "Enseignants"]
+    )
+
+# ======================
+# EXPORT DES INDISPONIBILITÉS (CSV / XLSX / PARQUET)
+# ======================
+DOSSIER_EXPORTS = os.path.join(tempfile.gettempdir(), "indisponibilites_exports")
+COLONNES_EXPORT = [
+    "id", "regle_id", "enseignant_id", "code", "nom", "prenom", "semaine", "jour", "jour_libelle",
+    "creneau", "creneau_libelle", "raisons", "commentaires_global", "timestamp"
+]
+COLONNES_EXPORT_ENTIERES = ("id", "regle_id", "enseignant_id")
+FORMATS_EXPORT = {
+    "CSV": ("csv", "text/csv"),
+    "Excel": ("xlsx", "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"),
+    "Parquet": ("parquet", "application/vnd.apache.parquet")
+}
+if importlib.util.find_spec("openpyxl") is None:
+    del FORMATS_EXPORT["Excel"]  # dépendance optionnelle
+
+def pages_export():
+    # Une page (≤ TAILLE_PAGE lignes) à la fois, jointe à l'annuaire et aux libellés
+    enseignants = {e["id"]: e for e in charger_annuaire(DEPARTEMENT["code"])["enseignants"]}
+    colonnes = "id,enseignant_id,semaine,jour,creneau,raisons,commentaires_global,timestamp"
+    pages = itertools.chain(parcourir_table("datas", colonnes, filtre_campagne), pages_regles_developpees(filtre_campagne))
+    for page in pages:
+        lignes = []
+        for r in page:
+            e = enseignants.get(r.get("enseignant_id"), {})
+            lignes.append({
+                **r,
+                "code": e.get("code"),
+                "nom": e.get("nom"),
+                "prenom": e.get("prenom"),
+                "semaine": str(r.get("semaine") or ""),
+                "jour_libelle": CODE_TO_JOUR.get(r.get("jour"), r.get("jour")),
+                "creneau_libelle": CODE_TO_CREN.get(r.get("creneau"), r.get("creneau"))
+            })
+        yield [[l.get(c) for c in COLONNES_EXPORT] for l in lignes]
+
+def ecrire_csv(chemin, pages):
+    import csv
+
+    # utf-8-sig : accents lisibles à l'ouverture dans Excel
+    with open(chemin, "w", newline="", encoding="utf-8-sig") as f:
+        writer = csv.writer(f, delimiter=";")
+        writer.writerow(COLONNES_EXPORT)
+        for page in pages:
+            writer.writerows(page)
+
+def ecrire_xlsx(chemin, pages):
+    from openpyxl import Workbook
+
+    # write_only : les lignes sont écrites au fil de l'eau, pas de feuille en mémoire
+    classeur = Workbook(write_only=True)
+    feuille = classeur.create_sheet("Indisponibilités")
+    feuille.append(COLONNES_EXPORT)
+    for page in pages:
+        for ligne in page:
+            feuille.append(ligne)
+    classeur.save(chemin)
+
+def ecrire_parquet(chemin, pages):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = pa.schema([
+        (c, pa.int64() if c in COLONNES_EXPORT_ENTIERES else pa.string()) for c in COLONNES_EXPORT
+    ])
+    # Un groupe de lignes par page
+    with pq.ParquetWriter(chemin, schema) as writer:
+        for page in pages:
+            colonnes = [
+                [v if v is None or c in COLONNES_EXPORT_ENTIERES else str(v) for v in valeurs]
+                for c, valeurs in zip(COLONNES_EXPORT, zip(*page))
+            ]
+            writer.write_table(pa.Table.from_arrays(colonnes, schema=schema))
+
+ECRIVAINS_EXPORT = {"csv": ecrire_csv, "xlsx": ecrire_xlsx, "parquet": ecrire_parquet}
+
+def fichier_export(extension):
+    # Fichier sur disque par version de la table : régénéré seulement si datas a changé
+    version = version_indisponibilites()
+    empreinte = hashlib.md5(repr((version, reference["version"])).encode()).hexdigest()[:12]
+    os.makedirs(DOSSIER_EXPORTS, exist_ok=True)
+    prefixe = f"datas_{DEPARTEMENT['code']}_"
+    chemin = os.path.join(DOSSIER_EXPORTS, f"{prefixe}{empreinte}.{extension}")
+    if not os.path.exists(chemin):
+        temporaire = f"{chemin}.{uuid.uuid4().hex[:6]}.tmp"
+        ECRIVAINS_EXPORT[extension](temporaire, pages_export())
+        os.replace(temporaire, chemin)
+        for nom in os.listdir(DOSSIER_EXPORTS):
+            ancien = os.path.join(DOSSIER_EXPORTS, nom)
+            if nom.startswith(prefixe) and nom.endswith(f".{extension}") and ancien != chemin:
+                os.remove(ancien)
+    return chemin
+
+def contenu_export(extension):
+    with open(fichier_export(extension), "rb") as f:
+        return f.read()
+
+# ======================
+# CRÉNEAUX LIBRES COMMUNS (MASQUES PAR ENSEIGNANT)
+# ======================
+def cache_masques(departement=None):
+    # enseignant_id -> (version référence, grille compactée) ; vidé à l'enregistrement de l'enseignant
+    return etat_departement("masques", {}, departement)
+
+def masques_enseignants(enseignant_ids):
+    cache = cache_masques()
+    manquants = [i for i in enseignant_ids if cache.get(i, (None,))[0] != reference["version"]]
+    if manquants:
+        cles = {i: [] for i in manquants}
+        for page in parcourir_table(
+            "datas", "id,enseignant_id,semaine,jour,creneau",
+            filtre=lambda q: filtre_campagne(q.in_("enseignant_id", manquants))
+        ):
+            for r in page:
+                cles[r["enseignant_id"]].append(cle_creneau(r["semaine"], r["jour"], r["creneau"]))
+        grilles = {i: cles_vers_grille(c) for i, c in cles.items()}
+        for page in parcourir_regles(lambda q: filtre_campagne(q.in_("enseignant_id", manquants))):
+            for r in page:
+                grilles[r["enseignant_id"]] |= grille_regle(regle_depuis_ligne(r))
+        for i, g in grilles.items():
+            cache[i] = (reference["version"], compacter_grille(g))
+    return {i: cache[i][1] for i in enseignant_ids}
+
+def creneaux_libres(enseignant_ids, semaines=None):
+    # Cellules (semaine, jour, creneau) où aucun des enseignants n'est indisponible, triées par semaine
+    masques = masques_enseignants(enseignant_ids)
+    if masques:
+        occupes = np.bitwise_or.reduce(np.stack([np.frombuffer(m, dtype=np.uint8) for m in masques.values()]))
+        libres = ~decompacter_grille(occupes.tobytes())
+    else:
+        libres = ~grille_vide()
+    if semaines is not None:
+        positions = INDEX["semaines"]["positions"]
+        libres[[i for c, i in positions.items() if c not in semaines]] = False
+    return grille_vers_cles(libres)
+
 # ======================
 # SESSION STATE INIT
 # ======================
 if "ponctuels" not in st.session_state:
-    st.session_state.ponctuels = []
+    st.session_state.ponctuels = {}  # (semaine, jour, creneau) -> {"raison": ...}, ordre d'ajout conservé
+if "regles" not in st.session_state:
+    st.session_state.regles = {}  # clé locale -> règle récurrente (voir nouvelle_regle)
 if "selected_user" not in st.session_state:
     st.session_state.selected_user = ""
 if "semaines_sel" not in st.session_state:
@@ -224,17 +2040,25 @@ if "semestre_filter" not in st.session_state:
     st.session_state.semestre_filter = "Toutes"
 if "email_utilisateur" not in st.session_state:
     st.session_state.email_utilisateur = ""
+if "_conflit_sauvegarde" not in st.session_state:
+    st.session_state._conflit_sauvegarde = False
+if "_sauvegarde_journal" not in st.session_state:
+    st.session_state._sauvegarde_journal = None  # id de la dernière entrée du journal pas encore rejouée
 
 
 # ======================
 # MODE UTILISATEUR / ADMIN
 # ======================
+if len(DEPARTEMENTS) > 1:
+    st.caption(f"Département : {DEPARTEMENT['nom']}")
 mode = st.radio("Mode", ["Utilisateur", "Administrateur"])
 
 # ======================
 # MODE ADMIN
 # ======================
 if mode == "Administrateur":
+    import pandas as pd
+
     # 🔑 Vérification mot de passe
     pwd_input = st.text_input("Entrez le mot de passe administrateur :", type="password")
     if pwd_input != ADMIN_IASSWORD:
@@ -252,49 +2076,347 @@ if mode == "Administrateur":
     st.session_state.semestre_filter = semestre_choice
     st.write(f"Semestres configurés : {st.session_state.semestre_filter}")
 
-    # --- Sauvegarde du filtre dans la feuille Config ---
+    # --- Sauvegarde du filtre dans Config, seulement s'il a changé ---
+    config_rows = reference["Config"]
+    if (config_rows[1][0] if len(config_rows) > 1 else None) != st.session_state.semestre_filter:
+        try:
+            ecrire_config(config_rows, st.session_state.semestre_filter)
+            # les nouvelles sessions doivent voir le nouveau filtre
+            charger_donnees_reference.clear(DEPARTEMENT["code"])
+            if campagne_active(DEPARTEMENT["code"]):
+                client_supabase().table("campagnes").update(
+                    {"semestre_filter": st.session_state.semestre_filter}
+                ).eq("id", campagne_active(DEPARTEMENT["code"])["id"]).execute()
+                campagne_active.clear(DEPARTEMENT["code"])
+        except Exception as e:
+            st.warning(f"⚠️ Impossible de sauvegarder le filtre dans Config.\n{e}")
+
+    # --- Données de référence ---
+    st.caption(
+        f"Données de référence (Creneaux, Jours, Semaines, Utilisateurs, Config) et liste des enseignants "
+        f"mises en cache {TTL_REFERENCE // 60} min pour toutes les sessions. "
+        f"Source : {'Supabase (table reference)' if etat_reference()['source'] == 'supabase' else 'Google Sheets'}."
+    )
+    if st.button("🔄 Recharger les données de référence", key="admin_reload_reference"):
+        # après une migration (outils/migrer_reference.py), repasse sur Supabase
+        etat_reference()["source"] = "supabase"
+        charger_donnees_reference.clear(DEPARTEMENT["code"])
+        charger_annuaire.clear(DEPARTEMENT["code"])
+        st.rerun()
+
+    # ======================
+    # CARTE DES INDISPONIBILITÉS
+    # ======================
+    st.subheader("📊 Carte des indisponibilités")
     try:
-        rows = st.session_state.config_sheet.get_all_values()
-        if len(rows) < 2:
-            st.session_state.config_sheet.append_row([st.session_state.semestre_filter])
-        else:
-            st.session_state.config_sheet.update("A2", [[st.session_state.semestre_filter]])
+        indispos = charger_toutes_indisponibilites(version_indisponibilites())
+        annuaire = charger_annuaire(DEPARTEMENT["code"])
     except Exception as e:
-        st.warning(f"⚠️ Impossible de sauvegarder le filtre dans Config.\n{e}")
+        st.error(f"⚠️ Impossible de charger les indisponibilités : {e}")
+        indispos = None
+
+    if indispos is not None:
+        f1, f2 = st.columns([1, 2])
+        parite = f1.selectbox("Semaines", ["Toutes", "Pairs", "Impairs"], key="admin_carte_parite")
+        noms = annuaire["libelles"]
+        groupe = f2.multiselect(
+            "Groupe d'enseignants (vide = tous)", list(noms), format_func=noms.get, key="admin_carte_groupe"
+        )
+
+        groupe_semaines = {"Pairs": "SP", "Impairs": "SI"}.get(parite)
+        semaines_visibles = [
+            c for c in INDEX["semaines"]["codes"]
+            if groupe_semaines is None or INDEX["semaines"]["groupe_de"].get(c) == groupe_semaines
+        ]
+        selection = indispos[indispos["enseignant_id"].isin(groupe)] if groupe else indispos
+        comptes = compter_par_cellule(selection)
+
+        m1, m2 = st.columns(2)
+        m1.metric("Enseignants ayant saisi", selection["enseignant_id"].nunique())
+        m2.metric("Créneaux indisponibles", len(selection))
+        st.altair_chart(carte_chaleur(comptes, semaines_visibles))
+
+        # ======================
+        # CRÉNEAUX LIBRES COMMUNS
+        # ======================
+        st.subheader("🤝 Créneaux libres communs")
+        ids_libres = st.multiselect(
+            "Enseignants devant être tous disponibles", list(noms), format_func=noms.get, key="admin_libres_groupe"
+        )
+        if ids_libres:
+            try:
+                debut = datetime.now()
+                libres = creneaux_libres(ids_libres, semaines_visibles)
+                duree_ms = (datetime.now() - debut).total_seconds() * 1000
+            except Exception as e:
+                st.error(f"⚠️ Impossible de calculer les créneaux libres : {e}")
+                libres = None
+
+            if libres is not None:
+                st.caption(f"{len(libres)} créneau(x) libre(s) pour {len(ids_libres)} enseignant(s) — calculé en {duree_ms:.0f} ms")
+                if libres:
+                    st.dataframe(
+                        pd.DataFrame({
+                            "Semaine": [s for s, _, _ in libres],
+                            "Jour": [CODE_TO_JOUR.get(j, j) for _, j, _ in libres],
+                            "Créneau": [CODE_TO_CREN.get(c, c) for _, _, c in libres]
+                        }),
+                        hide_index=True
+                    )
 
     # ======================
-    # SUPPRESSION DES LIGNES DE LA FEUILLE 1
+    # EXPORT DES INDISPONIBILITÉS
     # ======================
-    st.subheader("⚠️ Supprimer toutes les indisponibilités")
-    st.write("Cette action supprimera toutes les lignes de la Feuille 1 à partir de la ligne 2, mais conservera l'en-tête.")
-
-    #if st.button("❌ Supprimer toutes les lignes de la Feuille 1 (à partir de la ligne 2)",key="admin_delete_all_rows"):
-        #try:
-            # Récupération de l'en-tête (1ère ligne)
-            #header = st.session_state.sheet.get_all_values()[0:1]
+    st.subheader("📤 Exporter les indisponibilités")
+    st.caption("Toute la table datas, avec le nom des enseignants et les libellés des jours et créneaux.")
+    format_export = st.radio("Format", list(FORMATS_EXPORT), horizontal=True, key="admin_format_export")
+    extension, mime = FORMATS_EXPORT[format_export]
+    # Fichier généré au clic (fil séparé) puis réutilisé tant que la table ne change pas
+    st.download_button(
+        f"⬇️ Télécharger ({extension})",
+        lambda: contenu_export(extension),
+        file_name=f"indisponibilites_{datetime.now().strftime('%Y%m%d')}.{extension}",
+        mime=mime,
+        on_click="ignore",
+        key="admin_export"
+    )
 
-            # Vider entièrement la feuille
-            #st.session_state.sheet.clear()
+    # ======================
+    # JOURNAL DES ENREGISTREMENTS
+    # ======================
+    st.subheader("💾 Enregistrements en attente")
+    journal = journal_sauvegardes()
+    if journal is None:
+        st.caption("Journal local indisponible : les enregistrements sont écrits directement dans Supabase.")
+    else:
+        en_attente = lire_journal(
+            journal,
+            "select id, enseignant_id, cree_le, statut, tentatives, erreur from sauvegardes where departement = ? order by id",
+            (DEPARTEMENT["code"],)
+        )
+        conflits = sum(1 for e in en_attente if e[3] == "conflit")
+        st.caption(
+            f"{len(en_attente) - conflits} enregistrement(s) en attente d'envoi vers Supabase et {conflits} en conflit "
+            f"(modifiés ailleurs, en attente du choix de l'enseignant) dans ce serveur ({journal['chemin']})."
+        )
+        if en_attente:
+            libelles = charger_annuaire(DEPARTEMENT["code"])["libelles"]
+            st.dataframe(pd.DataFrame(
+                [
+                    {"enseignant": libelles.get(e, e), "cree_le": c, "statut": statut, "tentatives": t, "erreur": err}
+                    for _, e, c, statut, t, err in en_attente
+                ]
+            ), hide_index=True)
+            if st.button("🔁 Réessayer maintenant", key="admin_rejouer_journal"):
+                journal["reveil"].set()
+                st.rerun()
 
-            # Réécrire uniquement l'en-tête
-            #if header:
-                #st.session_state.sheet.append_rows(header, value_input_option="USER_ENTERED")
+    # ======================
+    # SUIVI DES EMAILS
+    # ======================
+    st.subheader("📨 Emails")
+    st.caption(f"{len(boite_envoi()['file'])} email(s) en file d'attente dans ce serveur.")
+    try:
+        emails = (
+            client_supabase().table("emails").select("id,cree_le,destinataire,sujet,statut,tentatives,erreur")
+            .order("id", desc=True).limit(50).execute().data
+        )
+    except Exception as e:
+        st.warning(f"⚠️ Historique des emails indisponible (table emails) : {e}")
+        emails = [
+            {k: m[k] for k in ("destinataire", "statut", "tentatives", "erreur")}
+            for m in reversed(boite_envoi()["traites"])
+        ]
+    if emails:
+        st.dataframe(pd.DataFrame(emails), hide_index=True)
+    else:
+        st.write("Aucun email envoyé.")
 
-            # Rafraîchir les données en mémoire
-            #st.session_state.all_data = st.session_state.sheet.get_all_values()
+    # ======================
+    # RELANCE DES ENSEIGNANTS SANS SAISIE
+    # ======================
+    st.subheader("🔔 Relancer les enseignants sans saisie")
+    periode = {"Pairs": "semestres pairs", "Impairs": "semestres impairs"}.get(st.session_state.semestre_filter, "tous les semestres")
+    sujet_rappel = st.text_input("Objet", "Rappel : saisie de vos indisponibilités", key="admin_rappel_sujet")
+    modele_rappel = st.text_area("Message", MODELE_RAPPEL, height=200, key="admin_rappel_modele")
 
-            #st.success("✅ Toutes les lignes ont été supprimées, l'en-tête est conservé !")
-        #except Exception as e:
-            #st.error(f"⚠️ Impossible de supprimer les lignes : {e}")
-    if st.button("❌ Supprimer toutes les lignes de la table datas", key="admin_delete_all_rows"):
+    if st.button("👁️ Aperçu (aucun envoi)", key="admin_rappel_apercu"):
         try:
-            supabase.table("datas").delete().neq("id", 0).execute()
-            st.session_state.all_data = []
-            st.success("✅ Toutes les lignes ont été supprimées !")
+            st.session_state._rappel_cibles = enseignants_sans_saisie()
         except Exception as e:
-            st.error(f"⚠️ Impossible de supprimer les lignes : {e}")
+            st.error(f"⚠️ Impossible de lister les enseignants sans saisie : {e}")
+
+    cibles = st.session_state.get("_rappel_cibles")
+    if cibles is not None:
+        avec_email = [e for e in cibles if e.get("email")]
+        st.write(f"{len(cibles)} enseignant(s) sans saisie, dont {len(cibles) - len(avec_email)} sans adresse email (non relancés).")
+        if cibles:
+            st.dataframe(
+                pd.DataFrame([{
+                    "Code": e["code"], "Nom": e.get("nom"), "Prénom": e.get("prenom"),
+                    "Email": e.get("email") or "⚠️ aucune"
+                } for e in cibles]),
+                hide_index=True
+            )
+        if avec_email:
+            with st.expander(f"Exemple de message ({avec_email[0]['code']})"):
+                st.text(rendre_rappel(modele_rappel, parametres_rappel(avec_email[0], periode)))
+            if st.button(f"📨 Envoyer {len(avec_email)} relance(s)", key="admin_rappel_envoi"):
+                envoyer_rappels(avec_email, sujet_rappel, modele_rappel, periode)
+                st.session_state._rappel_cibles = None
+                st.success(f"✅ {len(avec_email)} relance(s) mise(s) en file d'envoi (voir 📨 Emails).")
+
+    # ======================
+    # INSTRUMENTATION
+    # ======================
+    with st.expander("🔬 Instrumentation des appels"):
+        journal = journal_appels()
+        journal["actif"] = st.toggle("Mesurer les appels Supabase / Sheets / Brevo", value=journal["actif"], key="admin_instrumentation")
+        appels = list(journal["appels"])
+        if appels:
+            df_appels = pd.DataFrame(appels)
+            nb_executions = st.slider("Dernières exécutions affichées", 1, 50, 10, key="admin_instrumentation_n")
+            par_execution = (
+                df_appels[df_appels["execution"].notna()]
+                .pivot_table(index=["session", "execution"], columns="service", values="duree_ms", aggfunc=["sum", "count"], fill_value=0)
+            )
+            par_execution.columns = [f"{service} ({'ms' if agg == 'sum' else 'appels'})" for agg, service in par_execution.columns]
+            debuts = df_appels.groupby(["session", "execution"])["horodatage"].min()
+            par_execution = par_execution.join(debuts).sort_values("horodatage", ascending=False).head(nb_executions)
+            st.dataframe(par_execution.reset_index(), hide_index=True)
+            with st.expander("Détail des appels"):
+                st.dataframe(df_appels.iloc[::-1].head(500), hide_index=True)
+            c1, c2 = st.columns(2)
+            c1.download_button(
+                "⬇️ Exporter (JSON lines)",
+                "\n".join(json.dumps(a, ensure_ascii=False) for a in appels),
+                file_name=f"appels_{datetime.now().strftime('%Y%m%d_%H%M%S')}.jsonl",
+                mime="application/jsonl",
+                key="admin_instrumentation_export"
+            )
+            if c2.button("🧹 Vider le journal", key="admin_instrumentation_vider"):
+                journal["appels"].clear()
+                st.rerun()
+        else:
+            st.caption("Aucun appel enregistré.")
 
+    # ======================
+    # TEMPS DE DÉMARRAGE
+    # ======================
+    with st.expander("⏱️ Temps de démarrage et d'exécution"):
+        rapport = rapport_demarrage()
+        st.caption(f"Processus démarré le {rapport['debut'].strftime('%Y-%m-%d %H:%M:%S')} (étapes chronométrées à leur première exécution).")
+        st.dataframe(
+            pd.DataFrame({"Étape": list(rapport["etapes"]), "Durée (ms)": [round(d) for d in rapport["etapes"].values()]}),
+            hide_index=True
+        )
+        st.dataframe(
+            pd.DataFrame(list(rapport["executions"]), columns=["Heure", "Mode", "Durée (ms)"]).iloc[::-1],
+            hide_index=True
+        )
 
+    # ======================
+    # CAMPAGNES
+    # ======================
+    st.subheader("📚 Campagnes")
+    if st.session_state.get("_message_campagne"):
+        st.success(st.session_state.pop("_message_campagne"))
+    campagne = campagne_active(DEPARTEMENT["code"])
+    if etat_campagnes()["disponible"]:
+        if campagne:
+            st.write(f"Campagne active : **{campagne['nom']}** (semaines : {campagne['semestre_filter']})")
+            st.caption("La clôture déplace toutes ses saisies (créneaux et règles) dans les tables d'archive, par lots.")
+            if st.button("🗄️ Clôturer et archiver la campagne", key="admin_cloturer_campagne"):
+                try:
+                    barre = st.progress(0.0, text="Archivage…")
+                    total = max(sum(version_table(t)[0] for t in tables_archivees()), 1)
+                    deplaces = cloturer_campagne(
+                        campagne, lambda n: barre.progress(min(n / total, 1.0), text=f"{n} ligne(s) archivée(s)…")
+                    )
+                    cache_masques().clear()
+                    generation_datas()["valeur"] += 1
+                    st.session_state._message_campagne = f"✅ Campagne « {campagne['nom']} » archivée ({deplaces} ligne(s))."
+                    st.rerun()
+                except Exception as e:
+                    st.error(f"⚠️ Archivage interrompu (il reprendra là où il s'est arrêté) : {e}")
+        else:
+            st.info("Aucune campagne active : les saisies seront rattachées à la prochaine campagne ouverte.")
+            with st.form("admin_nouvelle_campagne"):
+                nom_campagne = st.text_input(
+                    "Nom de la campagne", placeholder=f"{datetime.now().year} S1 {st.session_state.semestre_filter.lower()}"
+                )
+                st.caption(f"Semaines : {st.session_state.semestre_filter} (filtre semestre ci-dessus)")
+                if st.form_submit_button("🚀 Ouvrir la campagne") and nom_campagne.strip():
+                    try:
+                        ouvrir_campagne(nom_campagne.strip(), st.session_state.semestre_filter)
+                        generation_datas()["valeur"] += 1
+                        st.rerun()
+                    except Exception as e:
+                        st.error(f"⚠️ Impossible d'ouvrir la campagne : {e}")
+
+        campagnes = lister_campagnes()
+        if campagnes:
+            st.dataframe(pd.DataFrame(campagnes), hide_index=True)
+        if len(campagnes) >= 2:
+            noms_campagnes = {c["id"]: c["nom"] for c in campagnes}
+            comparees = st.multiselect(
+                "Comparer les campagnes", list(noms_campagnes), format_func=noms_campagnes.get,
+                max_selections=4, key="admin_campagnes_comparees"
+            )
+            if comparees:
+                statuts = {c["id"]: c["statut"] for c in campagnes}
+                resume, par_creneau = [], {}
+                for cid in comparees:
+                    df = (
+                        charger_toutes_indisponibilites(version_indisponibilites()) if statuts[cid] == "active"
+                        else charger_campagne_archivee(DEPARTEMENT["code"], cid)
+                    )
+                    resume.append({
+                        "Campagne": noms_campagnes[cid],
+                        "Enseignants ayant saisi": df["enseignant_id"].nunique(),
+                        "Créneaux indisponibles": len(df),
+                        "Créneaux par enseignant": round(len(df) / max(df["enseignant_id"].nunique(), 1), 1)
+                    })
+                    par_creneau[noms_campagnes[cid]] = (
+                        df["jour"].map(lambda j: CODE_TO_JOUR.get(j, j)) + " · " + df["creneau"].map(lambda c: CODE_TO_CREN.get(c, c))
+                    ).value_counts()
+                st.dataframe(pd.DataFrame(resume), hide_index=True)
+                st.bar_chart(pd.DataFrame(par_creneau).fillna(0), stack=False)
+    else:
+        # ======================
+        # SUPPRESSION DES LIGNES (SANS TABLE CAMPAGNES)
+        # ======================
+        st.subheader("⚠️ Supprimer toutes les indisponibilités")
+        st.write("Cette action supprimera toutes les lignes de la Feuille 1 à partir de la ligne 2, mais conservera l'en-tête.")
+
+        #if st.button("❌ Supprimer toutes les lignes de la Feuille 1 (à partir de la ligne 2)",key="admin_delete_all_rows"):
+            #try:
+                # Récupération de l'en-tête (1ère ligne)
+                #header = st.session_state.sheet.get_all_values()[0:1]
+
+                # Vider entièrement la feuille
+                #st.session_state.sheet.clear()
+
+                # Réécrire uniquement l'en-tête
+                #if header:
+                    #st.session_state.sheet.append_rows(header, value_input_option="USER_ENTERED")
+
+                # Rafraîchir les données en mémoire
+                #st.session_state.all_data = st.session_state.sheet.get_all_values()
+
+                #st.success("✅ Toutes les lignes ont été supprimées, l'en-tête est conservé !")
+            #except Exception as e:
+                #st.error(f"⚠️ Impossible de supprimer les lignes : {e}")
+        if st.button("❌ Supprimer toutes les lignes de la table datas", key="admin_delete_all_rows"):
+            try:
+                client_supabase().table("datas").delete().neq("id", 0).execute()
+                if etat_regles()["disponible"]:
+                    client_supabase().table("regles").delete().neq("id", 0).execute()
+                cache_masques().clear()
+                generation_datas()["valeur"] += 1
+                st.success("✅ Toutes les lignes ont été supprimées !")
+            except Exception as e:
+                st.error(f"⚠️ Impossible de supprimer les lignes : {e}")
 
 
 # ======================
@@ -310,6 +2432,8 @@ else:
         st.caption("     *Voeux semestres pairs— période correspondante : S6*")
     else:
         st.caption("     *Voeux pour tous les semestres.*")
+    if campagne_active(DEPARTEMENT["code"]):
+        st.caption(f"     Campagne : {campagne_active(DEPARTEMENT['code'])['nom']}")
 
     st.divider()
     st.subheader("👨‍🏫 Informations Enseignant")
@@ -318,8 +2442,8 @@ else:
     # 1️⃣ Charger enseignants depuis Supabase
     # ======================
     try:
-        resp_enseignants = supabase.table("enseignants").select("*").order("code").execute()
-        enseignants = resp_enseignants.data
+        annuaire = charger_annuaire(DEPARTEMENT["code"])
+        enseignants = annuaire["enseignants"]
     except Exception as e:
         st.error(f"Erreur chargement enseignants : {e}")
         st.stop()
@@ -338,20 +2462,18 @@ else:
     # ======================
     # 3️⃣ Récupérer ID enseignant
     # ======================
-    resp_user = supabase.table("enseignants").select("id").eq("code", user_code).execute()
-
-    if not resp_user.data:
+    if user_code not in annuaire["id_par_code"]:
         st.error("⚠️ Enseignant introuvable dans la base")
         st.stop()
 
-    enseignant_id = resp_user.data[0]["id"]
+    enseignant_id = annuaire["id_par_code"][user_code]
 
     st.text_input("Votre adresse email pour recevoir le récapitulatif (facultatif):", key="email_utilisateur")
 
     # ======================
     # Filtrage semaines
     # ======================
-    all_semaines = st.session_state.semaines_data
+    all_semaines = semaines_data
     if st.session_state.semestre_filter == "Pairs":
         filtered_semaines = [s for s in all_semaines if s[2] == "SP"]
     elif st.session_state.semestre_filter == "Impairs":
@@ -365,30 +2487,18 @@ else:
     if st.session_state.selected_user != user_code:
         st.session_state.selected_user = user_code
 
-        resp_data = supabase.table("datas").select("*").eq("enseignant_id", enseignant_id).execute()
-        user_rows = resp_data.data
-
-        st.session_state.ponctuels = []
-        deja_vus = set()
-
-        for r in user_rows:
-            if r.get("code_streamlit", "").endswith("_I"):
-                semaine = str(r.get("semaine", ""))
-                jour = r.get("jour", "")
-                creneau = r.get("creneau", "")
-
-                key = (semaine, jour, creneau)
-
-                if key not in deja_vus:
-                    deja_vus.add(key)
-                    st.session_state.ponctuels.append({
-                        "id": str(uuid.uuid4()),
-                        "semaine": semaine,
-                        "jour": jour,
-                        "creneau": creneau,
-                        "raison": r.get("raisons", "")
-                    })
+        regles_rows = lire_regles_enseignant(enseignant_id, forcer=True)
+        snapshot = charger_snapshot(lire_datas_enseignant(enseignant_id, forcer=True), regles_rows)
 
+        st.session_state.ponctuels = {key: {"raison": v["raison"]} for key, v in snapshot.items()}
+        charger_regles_session(regles_rows)
+        st.session_state._conflit_sauvegarde = False
+        st.session_state._sauvegarde_journal = None
+        journal = journal_sauvegardes()
+        en_attente = sauvegarde_en_attente(journal, enseignant_id) if journal else None
+        if en_attente:
+            charger_sauvegarde_session(*en_attente)
+        reconstruire_grille_session()
 
         # reset UI
         #st.session_state.semaines_sel = []
@@ -402,16 +2512,21 @@ else:
 
         if "email_utilisateur" in st.session_state:
             del st.session_state["email_utilisateur"]
+        st.session_state._commentaire_en_attente = en_attente[3]["commentaire"] if en_attente else None
 
         st.rerun()
 
     # ======================
     # Lecture données existantes
     # ======================
-    resp_data = supabase.table("datas").select("*").eq("enseignant_id", enseignant_id).execute()
-    user_rows = resp_data.data
+    journal = journal_sauvegardes()
+    if journal:
+        suivre_sauvegarde_session(journal, enseignant_id)
+    user_rows = lire_datas_enseignant(enseignant_id)
     codes_sheet = {r["code_streamlit"] for r in user_rows} if user_rows else set()
     commentaire_existant = user_rows[-1]["commentaires_global"] if user_rows else ""
+    if st.session_state.get("_commentaire_en_attente") is not None:
+        commentaire_existant = st.session_state._commentaire_en_attente  # pas encore rejoué
     dernier_timestamp = user_rows[-1].get("timestamp") if user_rows else None
     if dernier_timestamp:
         dernier_timestamp = str(dernier_timestamp)[:19]  # garde YYYY-MM-DDTHH:MM:SS
@@ -420,43 +2535,40 @@ else:
     if codes_sheet:
         msg = (
             "⚠️ Des indisponibilités sont déjà enregistrées pour vous.<br>"
-            "Toute modification effacera les anciennes données lors de l'enregistrement.<br>"
+            "Seules vos modifications seront envoyées lors de l'enregistrement.<br>"
         )
         if dernier_timestamp:
             msg += f"Dernière modification effectuée le : {dernier_timestamp}"
         st.markdown(msg, unsafe_allow_html=True)
+    if st.session_state._sauvegarde_journal is not None:
+        st.caption("💾 Dernier enregistrement en cours d'envoi vers Supabase.")
 
     # ======================
-    # Fonctions ajout (INCHANGÉES)
+    # Fonctions ajout (créneaux ponctuels ou règle récurrente)
     # ======================
-    def ajouter_creneaux(codes_sheet, user_code):
-        doublon = False
-        semaines_sel = get_semaines_nums(st.session_state.semaines_sel)
-        jours_codes = get_jours_codes(st.session_state.jours_sel)
-        creneaux_nums = get_creneaux_nums(st.session_state.creneaux_sel)
+    def ajouter_creneaux():
+        semaines_sel = resoudre_selection(INDEX["semaines"], st.session_state.semaines_sel)
+        jours_codes = resoudre_selection(INDEX["jours"], st.session_state.jours_sel)
+        creneaux_nums = resoudre_selection(INDEX["creneaux"], st.session_state.creneaux_sel)
         raison_texte = st.session_state.raison_sel
 
-        for s in semaines_sel:
-            for j_code in jours_codes:
-                for num in creneaux_nums:
-                    code = f"{user_code}_{j_code}_{num}_I"
-
-                    existe_streamlit = any(
-                        p["semaine"] == s and p["jour"] == j_code and p["creneau"] == num
-                        for p in st.session_state.ponctuels
-                    )
-                    existe_sheet = code in codes_sheet
-
-                    if existe_streamlit or existe_sheet:
-                        doublon = True
-                    else:
-                        st.session_state.ponctuels.append({
-                            "id": str(uuid.uuid4()),
-                            "semaine": s,
-                            "jour": j_code,
-                            "creneau": num,
-                            "raison": raison_texte
-                        })
+        # La grille de session contient aussi les lignes enregistrées (même clé) :
+        # doublons et nouveaux créneaux sont obtenus par opérations vectorisées
+        selection = selection_vers_grille(semaines_sel, jours_codes, creneaux_nums)
+        actuelle = grille_session()
+        doublon = bool((selection & actuelle).any())
+
+        nouveaux = selection & ~actuelle
+        if nouveaux.sum() > SEUIL_REGLE:
+            # Grande sélection : une seule règle ; les créneaux déjà présents en sont exclus
+            st.session_state.regles[f"n{uuid.uuid4().hex[:8]}"] = nouvelle_regle(
+                semaines_sel, jours_codes, creneaux_nums, raison_texte, grille_vers_cles(selection & actuelle)
+            )
+        else:
+            ponctuels = st.session_state.ponctuels
+            for key in grille_vers_cles(nouveaux):
+                ponctuels[key] = {"raison": raison_texte}
+        enregistrer_grille_session(actuelle | selection)
 
         #st.session_state.semaines_sel = []
         #st.session_state.jours_sel = []
@@ -469,65 +2581,184 @@ else:
         st.session_state._warning_doublon = doublon
 
     # ======================
-    # UI ajout (INCHANGÉE)
+    # UI ajout
     # ======================
     st.divider()
     st.subheader("🖊️ Saisir vos créneaux")
 
     semaines_selection =st.multiselect("Semaine(s)", [r[0] for r in filtered_semaines], key="semaines_sel")
-    jours_selection =st.multiselect("Jour(s)", [r[0] for r in st.session_state.jours_data], key="jours_sel")
+    jours_selection =st.multiselect("Jour(s)", [r[0] for r in jours_data], key="jours_sel")
 
-    creneaux_visibles = st.session_state.creneaux_data[:6]
+    creneaux_visibles = creneaux_data[:6]
     creneaux_labels = [r[0] for r in creneaux_visibles]
     creneaux_selection = st.multiselect("Créneau(x)",creneaux_labels,key="creneaux_sel")
 
-    #creneaux_selection =st.multiselect("Créneau(x)", [r[0] for r in st.session_state.creneaux_data], key="creneaux_sel")
+    #creneaux_selection =st.multiselect("Créneau(x)", [r[0] for r in creneaux_data], key="creneaux_sel")
 
     raison =st.text_area("Raisons", key="raison_sel", height=80)
-    #st.button("➕ Ajouter", on_click=ajouter_creneaux, args=(codes_sheet, user_code))
+    #st.button("➕ Ajouter", on_click=ajouter_creneaux)
     if st.button("➕ Ajouter"):
-        ajouter_creneaux(codes_sheet, user_code) 
+        ajouter_creneaux()
 
     if st.session_state._warning_doublon:
         st.warning("⚠️ Certains créneaux existaient déjà et n'ont pas été ajoutés.")
         st.session_state._warning_doublon = False
 
+    # ======================
+    # Import d'un fichier (CSV / iCalendar)
+    # ======================
+    with st.expander("📥 Importer un fichier (CSV ou iCalendar)"):
+        st.caption(
+            "CSV : colonnes `date;debut;fin;raison` (ex. `2025-09-08;08:00;12:00;Jury`) "
+            "ou `semaine;jour;creneau;raison` (codes ou libellés). "
+            "iCalendar : fichier .ics exporté de votre agenda (événements récurrents quotidiens ou hebdomadaires développés). "
+            "Les horaires sont rattachés à tous les créneaux qu'ils recouvrent ; sans horaire, toute la journée."
+        )
+        fichier = st.file_uploader(
+            "Fichier", type=["csv", "ics"], key=f"import_fichier_{st.session_state.get('_import_generation', 0)}"
+        )
+        if fichier is not None:
+            try:
+                analyse = analyser_import(
+                    lire_fichier_import(fichier.name, fichier.getvalue()),
+                    construire_table_import(reference["version"], reference),
+                    {r[1] for r in filtered_semaines},
+                    grille_session()
+                )
+            except Exception as e:
+                st.error(f"⚠️ Fichier illisible : {e}")
+                analyse = None
+
+            if analyse is not None:
+                m1, m2, m3 = st.columns(3)
+                m1.metric("Nouveaux créneaux", len(analyse["nouveaux"]))
+                m2.metric("Déjà présents / en double", analyse["deja_presents"] + analyse["doublons_fichier"])
+                m3.metric("Lignes rejetées", len(analyse["rejets"]))
+                if len(analyse["rejets"]):
+                    st.dataframe(analyse["rejets"].head(200), hide_index=True)
+                if analyse["nouveaux"] and st.button(f"📥 Importer {len(analyse['nouveaux'])} créneau(x)", key="import_valider"):
+                    importer_creneaux(analyse["nouveaux"])
+                    st.session_state._import_generation = st.session_state.get("_import_generation", 0) + 1
+                    st.session_state._import_message = f"✅ {len(analyse['nouveaux'])} créneau(x) importé(s) : pensez à enregistrer."
+                    st.rerun()
+        if st.session_state.get("_import_message"):
+            st.success(st.session_state.pop("_import_message"))
+
     st.divider()
 
     # ======================
-    # Tableau (INCHANGÉ)
+    # Tableau (règles, créneaux filtrables, vue grille)
     # ======================
     st.subheader("🗓️ Créneaux ajoutés/enregistrés")
 
-    if st.session_state.ponctuels:
+    def modifier_exceptions(cle):
+        # Les créneaux repris en ponctuel restent exclus de la règle (pas de doublon)
+        regle = st.session_state.regles.get(cle)
+        if regle is None:
+            return  # règle supprimée ou rechargée entre-temps
+        gardees = {tuple(e) for e in regle["exceptions"]} & set(st.session_state.ponctuels)
+        regle["exceptions"] = sorted(set(st.session_state[f"exceptions_{cle}"]) | gardees)
+        reconstruire_grille_session()
+
+    def libelle_cle(cle):
+        semaine, jour, creneau = cle
+        return f"{CODE_TO_SEMAINE.get(semaine, semaine)} · {CODE_TO_JOUR.get(jour, jour)} · {CODE_TO_CREN.get(creneau, creneau)}"
+
+    if st.session_state.ponctuels or st.session_state.regles:
         if st.button("❌ Supprimer tous les créneaux"):
-            st.session_state.ponctuels = []
+            st.session_state.ponctuels = {}
+            st.session_state.regles = {}
+            enregistrer_grille_session(grille_vide())
             st.success("✅ Tous les créneaux ont été supprimés !")
             st.rerun()
 
-        with st.expander("Voir les créneaux ajoutés/enregistrés", expanded=True):
-            h1, h2, h3, h4, h5 = st.columns([1, 1, 1, 1, 1])
-            h1.markdown("**Semaine**")
-            h2.markdown("**Jour**")
-            h3.markdown("**Créneau**")
-            h4.markdown("**Raison**")
-            h5.markdown("**🗑️**")
-
-            delete_id = None
-            for r in st.session_state.ponctuels:
-                c1, c2, c3, c4, c5 = st.columns([1, 1, 1, 1, 1])
-                c1.write(r["semaine"] or "-")
-                c2.write(CODE_TO_JOUR.get(r["jour"], r["jour"]) or "-")
-                c3.write(CODE_TO_CREN.get(r["creneau"], r["creneau"]) or "-")
-                c4.write(r.get("raison", "") or "-")
-                if c5.button("🗑️", key=f"del_{r['id']}"):
-                    delete_id = r["id"]
-
-        if delete_id:
-            st.session_state.ponctuels = [r for r in st.session_state.ponctuels if r["id"] != delete_id]
+    if (st.session_state.ponctuels or st.session_state.regles) and st.toggle("Vue grille compacte", key="vue_grille"):
+        import pandas as pd
+
+        # Semaines x (jour, créneau) de la grille de session : ponctuels et règles
+        grille = grille_session()
+        semaines_visibles = [INDEX["semaines"]["positions"][r[1]] for r in filtered_semaines if r[1] in INDEX["semaines"]["positions"]]
+        codes = [INDEX[axe]["codes"] for axe in AXES_GRILLE]
+        st.dataframe(
+            pd.DataFrame(
+                np.where(grille[semaines_visibles].reshape(len(semaines_visibles), -1), "●", ""),
+                index=[CODE_TO_SEMAINE.get(codes[0][i], codes[0][i]) for i in semaines_visibles],
+                columns=[f"{CODE_TO_JOUR.get(j, j)[:3]} {c}" for j in codes[1] for c in codes[2]]
+            )
+        )
+
+    if st.session_state.regles:
+        with st.expander("Voir les règles récurrentes", expanded=True):
+            delete_regle = None
+            for cle, regle in st.session_state.regles.items():
+                c1, c2, c3, c4 = st.columns([3, 2, 1, 1])
+                c1.write(libelle_regle(regle))
+                c2.write(regle.get("raison") or "-")
+                c3.write(f"{int(grille_regle(regle).sum())} créneaux")
+                if c4.button("🗑️", key=f"del_regle_{cle}"):
+                    delete_regle = cle
+                produit = grille_vers_cles(selection_vers_grille(regle["semaines"], regle["jours"], regle["creneaux"]))
+                ponctuels = st.session_state.ponctuels
+                cle_widget = f"exceptions_{cle}"
+                if cle_widget not in st.session_state:
+                    st.session_state[cle_widget] = [tuple(e) for e in regle["exceptions"] if tuple(e) not in ponctuels]
+                st.multiselect(
+                    "Sauf", [k for k in produit if k not in ponctuels], format_func=libelle_cle,
+                    key=cle_widget, on_change=modifier_exceptions, args=(cle,), placeholder="Aucune exception"
+                )
+
+        if delete_regle:
+            del st.session_state.regles[delete_regle]
+            st.session_state.pop(f"exceptions_{delete_regle}", None)
+            reconstruire_grille_session()
             st.rerun()
 
-    else:
+    if st.session_state.ponctuels:
+        import pandas as pd
+
+        with st.expander("Voir les créneaux ajoutés/enregistrés", expanded=True):
+            # Un seul tableau (virtualisé) quel que soit le nombre de créneaux
+            cles = list(st.session_state.ponctuels)
+            codes = np.array(cles, dtype=object).reshape(-1, 3)
+            f1, f2, f3 = st.columns(3)
+            filtres = [
+                colonne.multiselect(
+                    libelle, [c for c in INDEX[axe]["codes"] if c in set(codes[:, i])],
+                    format_func=lambda c, axe=axe: INDEX[axe]["code_vers_label"].get(c, c),
+                    key=f"filtre_{axe}", placeholder="Toutes"
+                )
+                for i, (colonne, libelle, axe) in enumerate(zip((f1, f2, f3), ("Semaine", "Jour", "Créneau"), AXES_GRILLE))
+            ]
+            garde = np.ones(len(cles), dtype=bool)
+            for i, valeurs in enumerate(filtres):
+                if valeurs:
+                    garde &= np.isin(codes[:, i], valeurs)
+
+            table = pd.DataFrame({
+                "Semaine": [CODE_TO_SEMAINE.get(s, s) or "-" for s in codes[:, 0]],
+                "Jour": [CODE_TO_JOUR.get(j, j) or "-" for j in codes[:, 1]],
+                "Créneau": [CODE_TO_CREN.get(c, c) or "-" for c in codes[:, 2]],
+                "Raison": [p.get("raison", "") or "-" for p in st.session_state.ponctuels.values()]
+            })[garde]
+            generation = st.session_state.get("_table_generation", 0)
+            # Streamlit garde les positions sélectionnées d'un tableau dont la clé ne change
+            # pas : la clé suit les lignes affichées (filtres, ajouts, changement d'enseignant)
+            affichees = hashlib.md5(repr([cles[i] for i in table.index]).encode()).hexdigest()[:12]
+            evenement = st.dataframe(
+                table, hide_index=True, on_select="rerun", selection_mode="multi-row",
+                key=f"table_creneaux_{generation}_{affichees}", height=min(400, 35 * (len(table) + 1) + 3)
+            )
+            # Positions dans le tableau filtré (inchangées par un tri dans le navigateur)
+            selection = table.index[evenement.selection.rows]
+            st.caption(f"{len(table)} créneau(x) affiché(s) sur {len(cles)}")
+            if st.button(f"🗑️ Supprimer la sélection ({len(selection)})", disabled=not len(selection)):
+                for i in selection:
+                    del st.session_state.ponctuels[cles[i]]
+                st.session_state._table_generation = generation + 1
+                reconstruire_grille_session()
+                st.rerun()
+
+    elif not st.session_state.regles:
         st.write("Aucune indisponibilité enregistrée.")
 
     st.divider()
@@ -539,35 +2770,99 @@ else:
     commentaire_global =st.text_area("💬 Commentaire global", value=commentaire_value, key="commentaire")
 
     # ======================
-    # Enregistrement (INCHANGÉ)
+    # Enregistrement (journal local ou synchronisation directe)
     # ======================
-    if st.button("💾 Enregistrer"):
-        now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-
-        supabase.table("datas").delete().eq("enseignant_id", enseignant_id).execute()
-
-        for p in st.session_state.ponctuels:
-            supabase.table("datas").insert({
-                "enseignant_id": enseignant_id,
-                "semaine": int(p.get("semaine", 0)),
-                "jour": p.get("jour", ""),
-                "creneau": p.get("creneau", ""),
-                "code_creneau": f"{p.get('jour','')}_{p.get('creneau','')}",
-                "code_streamlit": f"{user_code}_{p.get('semaine','')}_{p.get('jour','')}_{p.get('creneau','')}_I",
-                "raisons": p.get("raison", ""),
-                "commentaires_global": st.session_state.commentaire
-            }).execute()
-
-        st.success("✅ Indisponibilités enregistrées dans la base Supabase")
+    def confirmer_enregistrement(enseignant_id, user_code, journal=None):
+        if journal:
+            # Supabase n'est à jour qu'après le rejeu : snapshot rechargé par suivre_sauvegarde_session
+            st.success("✅ Indisponibilités enregistrées (envoi vers Supabase en arrière-plan)")
+        else:
+            regles_rows = lire_regles_enseignant(enseignant_id, forcer=True)
+            snapshot = charger_snapshot(lire_datas_enseignant(enseignant_id, forcer=True), regles_rows)
+            if not etat_regles()["disponible"] and st.session_state.regles:
+                # Règles enregistrées développées : elles reviennent en créneaux ponctuels
+                st.session_state.ponctuels = {key: {"raison": v["raison"]} for key, v in snapshot.items()}
+            charger_regles_session(regles_rows)
+            reconstruire_grille_session()
+            cache_masques().pop(enseignant_id, None)
+            st.success("✅ Indisponibilités enregistrées dans la base Supabase")
 
         # email
         destinataire = st.session_state.email_utilisateur
-        if destinataire:
-            sujet = f"Récapitulatif des indisponibilités - {now}"
-            contenu = generer_contenu_email(user_code, st.session_state.ponctuels, st.session_state.commentaire, now)
-            success, msg = envoyer_email(destinataire, sujet, contenu)
+        if destinataire and journal:
+            # mis en file par le rejeu, une fois la saisie écrite dans Supabase (aucun en cas de conflit)
+            st.info(f"📨 Récapitulatif envoyé à {destinataire} dès l'enregistrement dans Supabase")
+        elif destinataire:
+            mettre_en_file_email(destinataire, recapitulatif_email(user_code))
+            st.info(f"📨 Récapitulatif en cours d'envoi à {destinataire}")
 
-            if success:
-                st.success(f"✅ Email envoyé à {destinataire}")
+    if st.button("💾 Enregistrer"):
+        journal = journal_sauvegardes()
+        try:
+            if journal:
+                # aucun appel à Supabase : le contrôle de conflit est fait au rejeu
+                journaliser_sauvegarde(journal, enseignant_id, user_code)
+                sauvegarde_ok = True
             else:
-                st.error(f"❌ Erreur envoi mail : {msg}")
+                sauvegarde_ok = synchroniser_indisponibilites(
+                    enseignant_id, user_code, st.session_state.ponctuels, st.session_state.commentaire,
+                    st.session_state.regles.values()
+                )
+        except Exception as e:
+            st.error(f"❌ Erreur lors de l'enregistrement : {e}")
+            st.stop()
+
+        if sauvegarde_ok:
+            confirmer_enregistrement(enseignant_id, user_code, journal)
+        else:
+            st.session_state._conflit_sauvegarde = CONFLIT_MODIFIEE
+
+    if st.session_state._conflit_sauvegarde:
+        if st.session_state._conflit_sauvegarde == CONFLIT_CAMPAGNE:
+            # « Écraser » écrit alors la saisie dans la campagne active
+            st.warning("⚠️ La campagne de saisie a été clôturée avant l'envoi de votre enregistrement vers Supabase.")
+        else:
+            st.warning("⚠️ Vos indisponibilités ont été modifiées ailleurs (autre onglet ou appareil) depuis leur chargement.")
+        c1, c2 = st.columns(2)
+        if c1.button("🔄 Recharger les données enregistrées"):
+            st.session_state._conflit_sauvegarde = False
+            journal = journal_sauvegardes()
+            if journal:
+                abandonner_sauvegarde(journal, enseignant_id)
+            st.session_state.selected_user = ""
+            st.rerun()
+        if c2.button("⚠️ Écraser avec ma saisie"):
+            st.session_state._conflit_sauvegarde = False
+            journal = journal_sauvegardes()
+            try:
+                if journal:
+                    # le rejeu aligne le serveur sur la saisie, quel que soit son état
+                    abandonner_sauvegarde(journal, enseignant_id)
+                    journaliser_sauvegarde(journal, enseignant_id, user_code, forcer=True)
+                else:
+                    enregistrer_indisponibilites(
+                        enseignant_id, user_code, st.session_state.ponctuels, st.session_state.commentaire,
+                        st.session_state.regles.values()
+                    )
+            except Exception as e:
+                st.error(f"❌ Erreur lors de l'enregistrement : {e}")
+                st.stop()
+            confirmer_enregistrement(enseignant_id, user_code, journal)
+
+# ======================
+# TEMPS D'EXÉCUTION DU SCRIPT
+# ======================
+rapport_demarrage()["executions"].append(
+    (datetime.now().strftime("%H:%M:%S"), mode, round((time.perf_counter() - DEBUT_EXECUTION) * 1000))
+)
+if journal_appels()["actif"]:
+    journal_appels()["appels"].append({
+        "horodatage": datetime.now().isoformat(timespec="milliseconds"),
+        "session": CONTEXTE_EXECUTION[0],
+        "execution": CONTEXTE_EXECUTION[1],
+        "service": "streamlit",
+        "operation": f"exécution du script ({mode})",
+        "duree_ms": round((time.perf_counter() - DEBUT_EXECUTION) * 1000, 2),
+        "octets": 0,
+        "statut": "ok"
+    })
@@ -0,0 +1,260 @@
+# ======================
+# BENCHMARK HORS LIGNE
+# ======================
+# Rejoue les parcours types de l'application avec streamlit.testing.v1.AppTest et
+# les services locaux (bench/faux_services.py), sans réseau :
+#
+#     python bench/benchmark.py [--enseignants 150] [--latence 30] [--json] [--sans-migration]
+#
+# Pour chaque parcours : durée, allers-retours par service et pic mémoire Python
+# (tracemalloc, qui ralentit l'exécution ; --sans-memoire pour des durées brutes).
+import argparse
+import json
+import sqlite3
+import sys
+import tempfile
+import time
+import tracemalloc
+from contextlib import closing
+from pathlib import Path
+
+RACINE = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(RACINE))
+
+from streamlit.testing.v1 import AppTest
+
+from bench import faux_services
+
+SECRETS = {
+    "SERVICES_LOCAUX": True,
+    "EMAIL_FROM": "planning@exemple.fr",
+    "admin_Iassword": "bench",
+    # journal des enregistrements propre à chaque exécution du benchmark
+    "JOURNAL_SAUVEGARDES": str(Path(tempfile.mkdtemp()) / "journal.sqlite3"),
+}
+DELAI_EMAILS = 10  # secondes d'attente max de la boîte d'envoi
+
+
+def nouvelle_session():
+    at = AppTest.from_file(str(RACINE / "Streamlit.py"), default_timeout=120)
+    for cle, valeur in SECRETS.items():
+        at.secrets[cle] = valeur
+    return at
+
+
+def resynchroniser_widgets(at):
+    # L'application supprime les clés des widgets de saisie après un ajout ;
+    # AppTest conserve l'ancienne valeur dans son arbre : on la réaligne.
+    for w in list(at.multiselect) + list(at.text_area) + list(at.text_input):
+        try:
+            w.value
+        except KeyError:
+            w._value = [] if w.type == "multiselect" else ""
+
+
+def verifier(at):
+    if at.exception:
+        raise RuntimeError(at.exception[0].value)
+
+
+def executer(at):
+    at.run()
+    resynchroniser_widgets(at)
+    verifier(at)
+
+
+def cliquer(at, libelle):
+    resynchroniser_widgets(at)
+    bouton = next(b for b in at.button if libelle in b.label)
+    bouton.click()
+    executer(at)
+
+
+def cliquer_cle(at, cle):
+    resynchroniser_widgets(at)
+    at.button(key=cle).click()
+    executer(at)
+
+
+def saisir(at, cle, valeur):
+    resynchroniser_widgets(at)
+    at.session_state[cle] = valeur
+    widget = next((w for w in list(at.multiselect) + list(at.text_input) + list(at.text_area) if w.key == cle), None)
+    if widget is not None:
+        widget._value = valeur
+
+
+def selectionner_lignes(at, lignes):
+    # Sélection dans le tableau des créneaux (clé table_creneaux_*, qui suit les lignes
+    # affichées). AppTest ne conserve pas la sélection d'un dataframe d'une exécution à
+    # l'autre : elle est posée dans l'état de session, une fois pour afficher le bouton
+    # de suppression, puis à nouveau pour l'exécution suivante (le clic).
+    cle = next(d.proto.id.split("-", 2)[2] for d in at.dataframe if "table_creneaux_" in d.proto.id)
+    selection = {"selection": {"rows": list(lignes), "columns": [], "cells": []}}
+    at.session_state[cle] = selection
+    executer(at)
+    at.session_state[cle] = selection
+
+
+def attendre_emails(nombre):
+    # Envoi puis statut final dans la table emails (écrit par la boîte d'envoi après l'envoi)
+    fin = time.monotonic() + DELAI_EMAILS
+    while time.monotonic() < fin and (
+        len(faux_services.EMAILS_ENVOYES) < nombre
+        or any(e["statut"] == "en_attente" for e in faux_services.TABLES["emails"])
+    ):
+        time.sleep(0.02)
+
+
+def attendre_journal():
+    # Rejeu des enregistrements vers Supabase (thread du journal SQLite)
+    fin = time.monotonic() + DELAI_EMAILS
+    with closing(sqlite3.connect(SECRETS["JOURNAL_SAUVEGARDES"])) as connexion:
+        while connexion.execute("select count(*) from sauvegardes where statut = 'en_attente'").fetchone()[0] and time.monotonic() < fin:
+            time.sleep(0.02)
+
+
+# ======================
+# PARCOURS
+# ======================
+def parcours(etat):
+    options_semaines = [r[0] for r in faux_services.FEUILLES["Semaines"][1:] if r[1].startswith("ALL_")]
+    options_jours = [r[0] for r in faux_services.FEUILLES["Jours"][1:] if r[1].startswith("ALL_")]
+    options_creneaux = [r[0] for r in faux_services.FEUILLES["Creneaux"][1:7]]
+
+    def demarrage():
+        etat["at"] = nouvelle_session()
+        executer(etat["at"])
+
+    def ajout_tout():
+        at = etat["at"]
+        saisir(at, "semaines_sel", options_semaines)
+        saisir(at, "jours_sel", options_jours)
+        saisir(at, "creneaux_sel", options_creneaux)
+        cliquer(at, "Ajouter")
+
+    def exclusions():
+        # La sélection complète est conservée comme une seule règle : 3 exceptions
+        at = etat["at"]
+        cle, regle = next(iter(at.session_state["regles"].items()))
+        exceptions = [(regle["semaines"][0], regle["jours"][0], c) for c in regle["creneaux"][:3]]
+        resynchroniser_widgets(at)
+        at.multiselect(key=f"exceptions_{cle}").set_value(exceptions)
+        executer(at)
+
+    def enregistrement():
+        at = etat["at"]
+        saisir(at, "email_utilisateur", "bench@exemple.fr")
+        deja_envoyes = len(faux_services.EMAILS_ENVOYES)
+        cliquer(at, "Enregistrer")
+        attendre_emails(deja_envoyes + 1)
+        attendre_journal()
+
+    def changement_utilisateur():
+        at = etat["at"]
+        selectbox = at.selectbox[0]
+        selectbox.set_value(selectbox.options[1])
+        executer(at)
+
+    def reexecution():
+        executer(etat["at"])
+
+    def session_chaude():
+        executer(nouvelle_session())
+
+    def ajout_ponctuels_et_regle():
+        # Enseignant courant (sans saisie) : 6 créneaux ponctuels et une règle
+        at = etat["at"]
+        saisir(at, "semaines_sel", ["S36", "S37"])
+        saisir(at, "jours_sel", ["Lundi"])
+        saisir(at, "creneaux_sel", options_creneaux[:3])
+        cliquer(at, "Ajouter")
+        saisir(at, "semaines_sel", options_semaines[:1])
+        saisir(at, "jours_sel", ["Mardi"])
+        saisir(at, "creneaux_sel", options_creneaux[:1])
+        cliquer(at, "Ajouter")
+
+    def suppressions():
+        # 3 créneaux sélectionnés dans le tableau puis « Supprimer la sélection », et une règle
+        at = etat["at"]
+        avant = list(at.session_state["ponctuels"])
+        selectionner_lignes(at, [0, 2, 4])
+        cliquer(at, "Supprimer la sélection")
+        restants = list(at.session_state["ponctuels"])
+        if restants != [c for i, c in enumerate(avant) if i not in (0, 2, 4)]:
+            raise RuntimeError(f"suppression de la sélection incorrecte : {restants}")
+        cle = next(iter(at.session_state["regles"]))
+        cliquer_cle(at, f"del_regle_{cle}")
+        if at.session_state["regles"]:
+            raise RuntimeError("règle non supprimée")
+
+    return [
+        ("Démarrage + sélection enseignant (à froid)", demarrage),
+        ("Ajout toutes semaines × jours × créneaux", ajout_tout),
+        ("Exclusion de 3 créneaux de la règle", exclusions),
+        ("Enregistrement + email récapitulatif", enregistrement),
+        ("Changement d'utilisateur", changement_utilisateur),
+        ("Réexécution sans action", reexecution),
+        ("Nouvelle session (caches chauds)", session_chaude),
+        ("Ajout de 6 créneaux ponctuels et d'une règle", ajout_ponctuels_et_regle),
+        ("Suppression de 3 créneaux sélectionnés et d'une règle", suppressions),
+    ]
+
+
+def mesurer(nom, action, memoire):
+    faux_services.reinitialiser_compteurs()
+    if memoire:
+        tracemalloc.start()
+    debut = time.perf_counter()
+    action()
+    duree_ms = (time.perf_counter() - debut) * 1000
+    pic = 0
+    if memoire:
+        _, pic = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    return {
+        "parcours": nom,
+        "duree_ms": round(duree_ms, 1),
+        "supabase": faux_services.APPELS["supabase"],
+        "sheets": faux_services.APPELS["sheets"],
+        "brevo": faux_services.APPELS["brevo"],
+        "octets_recus": sum(faux_services.OCTETS.values()),
+        "pic_memoire_kio": round(pic / 1024),
+    }
+
+
+def afficher(resultats):
+    colonnes = list(resultats[0])
+    largeurs = {c: max(len(c), *(len(str(r[c])) for r in resultats)) for c in colonnes}
+    print("  ".join(c.ljust(largeurs[c]) for c in colonnes))
+    for r in resultats:
+        print("  ".join(str(r[c]).ljust(largeurs[c]) for c in colonnes))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark hors ligne de Streamlit.py")
+    parser.add_argument("--enseignants", type=int, default=150)
+    parser.add_argument("--latence", type=float, default=0, help="latence simulée par aller-retour (ms)")
+    parser.add_argument("--sans-memoire", action="store_true", help="ne pas mesurer le pic mémoire")
+    parser.add_argument("--json", action="store_true", help="une ligne JSON par parcours")
+    parser.add_argument(
+        "--sans-migration", action="store_true",
+        help="données de référence lues dans Google Sheets (table reference absente)"
+    )
+    args = parser.parse_args()
+
+    faux_services.initialiser(args.enseignants, migration_reference=not args.sans_migration)
+    faux_services.LATENCE_MS = args.latence
+
+    etat = {}
+    resultats = [mesurer(nom, action, not args.sans_memoire) for nom, action in parcours(etat)]
+
+    if args.json:
+        for r in resultats:
+            print(json.dumps(r, ensure_ascii=False))
+    else:
+        afficher(resultats)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,435 @@
+# ======================
+# SERVICES LOCAUX (SANS RÉSEAU)
+# ======================
+# Doublures en mémoire de Supabase (API table/rpc), Google Sheets (gspread) et
+# Brevo (TransactionalEmailsApi), activées par `SERVICES_LOCAUX = true` dans
+# .streamlit/secrets.toml. Elles comptent les allers-retours par service et
+# peuvent simuler une latence réseau (LATENCE_MS) ou une panne de Supabase
+# (PANNE_SUPABASE) pour les benchmarks.
+import copy
+import hashlib
+import itertools
+import json
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timezone
+
+LATENCE_MS = 0
+PANNE_SUPABASE = False  # toute requête Supabase échoue (connexion refusée)
+APPELS = Counter()     # service -> nombre d'allers-retours
+OCTETS = Counter()     # service -> taille des réponses (JSON)
+EMAILS_ENVOYES = []
+
+_verrou = threading.RLock()
+_ids = itertools.count(1)
+
+# Clés étrangères connues pour les ressources imbriquées (select "datas()")
+CLES_ETRANGERES = {("enseignants", "datas"): "enseignant_id", ("enseignants", "regles"): "enseignant_id"}
+
+
+def aller_retour(service, reponse=None):
+    APPELS[service] += 1
+    if reponse is not None:
+        OCTETS[service] += len(json.dumps(reponse, default=str))
+    if LATENCE_MS:
+        time.sleep(LATENCE_MS / 1000)
+
+
+def verifier_disponibilite():
+    if PANNE_SUPABASE:
+        aller_retour("supabase")
+        raise ConnectionError("Supabase injoignable (panne simulée)")
+
+
+def reinitialiser_compteurs():
+    APPELS.clear()
+    OCTETS.clear()
+
+
+# ======================
+# DONNÉES DE DÉPART
+# ======================
+HORAIRES_CRENEAUX = ["08:00-09:30", "09:45-11:15", "11:30-13:00", "14:00-15:30", "15:45-17:15", "17:30-19:00"]
+
+
+def onglets_reference():
+    semaines = [
+        [f"S{n}", str(n), "SP" if n % 2 == 0 else "SI"]
+        for n in list(range(36, 53)) + list(range(1, 27))
+    ]
+    return {
+        "Creneaux": [["Libellé", "Code", "Groupe", "Horaires"]]
+        + [[f"Créneau {i}", str(i), "C", h] for i, h in enumerate(HORAIRES_CRENEAUX, start=1)]
+        + [["Tous les créneaux", "ALL_C", "C"]],
+        "Jours": [["Libellé", "Code", "Groupe"]]
+        + [[j, j[:2].upper(), "J"] for j in ("Lundi", "Mardi", "Mercredi", "Jeudi", "Vendredi")]
+        + [["Tous les jours", "ALL_J", "J"]],
+        "Semaines": [["Libellé", "Code", "Groupe"]]
+        + semaines
+        + [["Toutes les semaines impaires", "ALL_SI", "SI"], ["Toutes les semaines paires", "ALL_SP", "SP"]],
+        "Utilisateurs": [["Code", "Nom"]],
+        "Config": [["semestre_filter"], ["Toutes"]],
+    }
+
+
+def enseignants_fictifs(nombre):
+    return [
+        {
+            "id": next(_ids),
+            "code": f"E{i:03d}",
+            "nom": f"Nom{i:03d}",
+            "prenom": f"Prénom{i:03d}",
+            "email": f"e{i:03d}@exemple.fr" if i % 5 else None,
+        }
+        for i in range(1, nombre + 1)
+    ]
+
+
+TABLES = {}                     # schéma public
+SCHEMAS = {"public": TABLES}    # schéma -> tables (un schéma par département)
+FEUILLES = {}
+
+
+def reference_migree():
+    # Table reference telle que remplie par outils/migrer_reference.py
+    return [{"onglet": onglet, "lignes": copy.deepcopy(lignes)} for onglet, lignes in FEUILLES.items()]
+
+
+def initialiser(nombre_enseignants=150, migration_reference=True, schemas=("public",)):
+    with _verrou:
+        FEUILLES.clear()
+        FEUILLES.update(onglets_reference())
+        TABLES.clear()
+        for schema in list(SCHEMAS):
+            if schema != "public":
+                del SCHEMAS[schema]
+        for schema in schemas:
+            tables = SCHEMAS.setdefault(schema, {})
+            tables["enseignants"] = enseignants_fictifs(nombre_enseignants)
+            tables["datas"] = []
+            tables["regles"] = []
+            tables["emails"] = []
+            tables["campagnes"] = []
+            tables["datas_archive"] = []
+            tables["regles_archive"] = []
+            if migration_reference:
+                tables["reference"] = reference_migree()
+        EMAILS_ENVOYES.clear()
+        reinitialiser_compteurs()
+
+
+initialiser()
+
+
+# ======================
+# SUPABASE
+# ======================
+class Reponse:
+    def __init__(self, data, count=None):
+        self.data = data
+        self.count = count
+
+
+class ErreurApi(Exception):
+    def __init__(self, code, message):
+        super().__init__(f"{code}: {message}")
+        self.code = code
+        self.message = message
+
+
+class Requete:
+    def __init__(self, table, tables=TABLES):
+        self.table = table
+        self.tables = tables
+        self.operation = "select"
+        self.colonnes = "*"
+        self.compter = False
+        self.filtres = []
+        self.tris = []
+        self.limite = None
+        self.plage = None
+        self.donnees = None
+        self.conflit = "id"
+        self.erreur = None
+
+    # --- opérations
+    def select(self, *colonnes, count=None):
+        self.colonnes = ",".join(colonnes) or "*"
+        self.compter = count is not None
+        return self
+
+    def insert(self, donnees, **_):
+        self.operation, self.donnees = "insert", donnees
+        return self
+
+    def upsert(self, donnees, on_conflict="id", **_):
+        self.operation, self.donnees, self.conflit = "upsert", donnees, on_conflict
+        return self
+
+    def update(self, donnees, **_):
+        self.operation, self.donnees = "update", donnees
+        return self
+
+    def delete(self, **_):
+        self.operation = "delete"
+        return self
+
+    # --- filtres
+    def eq(self, col, val):
+        self.filtres.append(lambda r: r.get(col) == val)
+        return self
+
+    def neq(self, col, val):
+        self.filtres.append(lambda r: r.get(col) != val)
+        return self
+
+    def gt(self, col, val):
+        self.filtres.append(lambda r: r.get(col) is not None and r.get(col) > val)
+        return self
+
+    def lt(self, col, val):
+        self.filtres.append(lambda r: r.get(col) is not None and r.get(col) < val)
+        return self
+
+    def in_(self, col, valeurs):
+        valeurs = set(valeurs)
+        self.filtres.append(lambda r: r.get(col) in valeurs)
+        return self
+
+    def is_(self, col, val):
+        enfant = CLES_ETRANGERES.get((self.table, col))
+        if enfant and col not in self.tables:
+            self.erreur = ErreurApi("PGRST200", f"Could not find a relationship between '{self.table}' and '{col}'")
+        elif enfant:
+            # anti-jointure : aucune ligne enfant rattachée
+            self.filtres.append(
+                lambda r: not any(e.get(enfant) == r["id"] for e in self.tables.get(col, []))
+            )
+        else:
+            self.filtres.append(lambda r: r.get(col) is None)
+        return self
+
+    def order(self, col, desc=False, nullsfirst=None, **_):
+        self.tris.append((col, desc))
+        return self
+
+    def limit(self, n, **_):
+        self.limite = n
+        return self
+
+    def range(self, debut, fin, **_):
+        self.plage = (debut, fin)
+        return self
+
+    # --- exécution
+    def _selection(self):
+        return [r for r in self.tables.setdefault(self.table, []) if all(f(r) for f in self.filtres)]
+
+    def _projeter(self, lignes):
+        if self.colonnes == "*":
+            return lignes
+        colonnes = [c.strip() for c in self.colonnes.split(",") if c.strip() and "(" not in c]
+        return [{c: r.get(c) for c in colonnes} for r in lignes]
+
+    def _nouvelle_ligne(self, ligne):
+        ligne = dict(ligne)
+        if ligne.get("id") is None:
+            ligne["id"] = next(_ids)
+        ligne.setdefault("timestamp", datetime.now(timezone.utc).isoformat())
+        return ligne
+
+    def execute(self):
+        verifier_disponibilite()
+        if self.table not in self.tables:
+            self.erreur = ErreurApi("PGRST205", f"Could not find the table 'public.{self.table}' in the schema cache")
+        if self.erreur:
+            aller_retour("supabase")
+            raise self.erreur
+        with _verrou:
+            resultat = self._executer()
+        aller_retour("supabase", resultat.data)
+        return resultat
+
+    def _executer(self):
+        lignes = self.tables.setdefault(self.table, [])
+        if self.operation in ("insert", "upsert"):
+            donnees = self.donnees if isinstance(self.donnees, list) else [self.donnees]
+            par_cle = {r.get(self.conflit): r for r in lignes}
+            sortie = []
+            for d in donnees:
+                if self.operation == "upsert" and d.get(self.conflit) in par_cle:
+                    par_cle[d[self.conflit]].update(d)
+                    sortie.append(par_cle[d[self.conflit]])
+                else:
+                    ligne = self._nouvelle_ligne(d)
+                    lignes.append(ligne)
+                    sortie.append(ligne)
+            return Reponse(copy.deepcopy(sortie))
+
+        selection = self._selection()
+        if self.operation == "delete":
+            ids = {id(r) for r in selection}
+            self.tables[self.table] = [r for r in lignes if id(r) not in ids]
+            return Reponse(copy.deepcopy(selection))
+        if self.operation == "update":
+            for r in selection:
+                r.update(self.donnees)
+            return Reponse(copy.deepcopy(selection))
+
+        for col, desc in reversed(self.tris):
+            selection.sort(key=lambda r: (r.get(col) is None, str(r.get(col)) if col == "timestamp" else r.get(col)), reverse=desc)
+        total = len(selection)
+        if self.plage:
+            selection = selection[self.plage[0]:self.plage[1] + 1]
+        if self.limite is not None:
+            selection = selection[:self.limite]
+        return Reponse(copy.deepcopy(self._projeter(selection)), total if self.compter else None)
+
+
+class AppelRpc:
+    def __init__(self, nom, parametres, tables=TABLES):
+        self.nom = nom
+        self.parametres = parametres or {}
+        self.tables = tables
+
+    def execute(self):
+        verifier_disponibilite()
+        fonction = RPC.get(self.nom)
+        if self.nom == "lire_reference" and "reference" not in self.tables:
+            # fonction créée avec sa table (sql/reference.sql)
+            fonction = None
+        if fonction is None:
+            aller_retour("supabase")
+            raise ErreurApi("PGRST202", f"Could not find the function public.{self.nom}")
+        with _verrou:
+            data = fonction(self.tables, **self.parametres)
+        aller_retour("supabase", data)
+        return Reponse(data)
+
+
+def _inserer_datas(tables, enseignant_id, lignes):
+    for l in lignes:
+        tables["datas"].append(Requete("datas", tables)._nouvelle_ligne(dict(l, enseignant_id=enseignant_id)))
+
+
+def _ligne_campagne(r, enseignant_id, campagne_id):
+    # enseignant_id = ... and campagne_id is not distinct from p_campagne_id
+    return r.get("enseignant_id") == enseignant_id and r.get("campagne_id") == campagne_id
+
+
+def rpc_remplacer_indisponibilites(tables, p_enseignant_id, p_lignes, p_campagne_id=None):
+    tables["datas"] = [r for r in tables["datas"] if not _ligne_campagne(r, p_enseignant_id, p_campagne_id)]
+    _inserer_datas(tables, p_enseignant_id, [dict(l, campagne_id=p_campagne_id) for l in p_lignes])
+
+
+def rpc_appliquer_diff_indisponibilites(
+    tables, p_enseignant_id, p_suppressions, p_ajouts, p_modifications, p_commentaire=None, p_campagne_id=None
+):
+    maintenant = datetime.now(timezone.utc).isoformat()
+    suppressions = {str(i) for i in p_suppressions}
+    tables["datas"] = [
+        r for r in tables["datas"]
+        if not (_ligne_campagne(r, p_enseignant_id, p_campagne_id) and str(r["id"]) in suppressions)
+    ]
+    modifications = {m["id"]: m for m in p_modifications}
+    for r in tables["datas"]:
+        if r["id"] in modifications and r.get("enseignant_id") == p_enseignant_id:
+            r.update(raisons=modifications[r["id"]].get("raisons"), timestamp=maintenant)
+    _inserer_datas(tables, p_enseignant_id, [dict(l, campagne_id=p_campagne_id) for l in p_ajouts])
+    if p_commentaire is not None:
+        for r in tables["datas"]:
+            if _ligne_campagne(r, p_enseignant_id, p_campagne_id):
+                r.update(commentaires_global=p_commentaire, timestamp=maintenant)
+
+
+def rpc_archiver_lot(tables, p_table, p_campagne_id, p_taille=5000):
+    lot = [r for r in tables[p_table] if r.get("campagne_id") == p_campagne_id][:p_taille]
+    ids = {r["id"] for r in lot}
+    tables[p_table] = [r for r in tables[p_table] if r["id"] not in ids]
+    archives = {r["id"] for r in tables[f"{p_table}_archive"]}
+    tables[f"{p_table}_archive"].extend(r for r in lot if r["id"] not in archives)
+    return len(lot)
+
+
+def rpc_lire_reference(tables, p_version=None):
+    onglets = {r["onglet"]: r["lignes"] for r in tables["reference"]}
+    version = hashlib.md5(json.dumps(onglets, sort_keys=True).encode()).hexdigest()
+    if version == p_version:
+        return {"version": version}
+    return {"version": version, "onglets": copy.deepcopy(onglets)}
+
+
+RPC = {
+    "remplacer_indisponibilites": rpc_remplacer_indisponibilites,
+    "appliquer_diff_indisponibilites": rpc_appliquer_diff_indisponibilites,
+    "archiver_lot": rpc_archiver_lot,
+    "lire_reference": rpc_lire_reference,
+}
+
+
+class ClientSupabase:
+    def __init__(self, schema="public"):
+        self.tables = SCHEMAS.setdefault(schema, {})
+
+    def schema(self, nom):
+        return ClientSupabase(nom)
+
+    def table(self, nom):
+        return Requete(nom, self.tables)
+
+    def rpc(self, nom, parametres=None):
+        return AppelRpc(nom, parametres, self.tables)
+
+
+# ======================
+# GOOGLE SHEETS
+# ======================
+class FeuilleLocale:
+    def __init__(self, titre):
+        self.title = titre
+
+    def get_all_values(self):
+        valeurs = copy.deepcopy(FEUILLES[self.title])
+        aller_retour("sheets", valeurs)
+        return valeurs
+
+    def update(self, plage, valeurs):
+        # seule la forme "A2" est utilisée par l'application
+        ligne = int(plage[1:]) - 1
+        with _verrou:
+            while len(FEUILLES[self.title]) <= ligne:
+                FEUILLES[self.title].append([])
+            FEUILLES[self.title][ligne] = list(valeurs[0])
+        aller_retour("sheets")
+
+    def append_row(self, ligne):
+        with _verrou:
+            FEUILLES[self.title].append(list(ligne))
+        aller_retour("sheets")
+
+
+class ClasseurLocal:
+    def worksheet(self, titre):
+        aller_retour("sheets")
+        return FeuilleLocale(titre)
+
+    def values_batch_get(self, plages, params=None):
+        reponse = {
+            "valueRanges": [
+                {"range": p, "values": copy.deepcopy(FEUILLES[p.strip("'")])} for p in plages
+            ]
+        }
+        aller_retour("sheets", reponse)
+        return reponse
+
+
+# ======================
+# BREVO
+# ======================
+class ApiEmailsLocale:
+    def send_transac_email(self, message):
+        with _verrou:
+            EMAILS_ENVOYES.append(message)
+        aller_retour("brevo", message)
+        return {"messageId": f"<local-{len(EMAILS_ENVOYES)}@bench>"}
@@ -0,0 +1,109 @@
+# ======================
+# MIGRATION DES DONNÉES DE RÉFÉRENCE GOOGLE SHEETS -> SUPABASE
+# ======================
+# Recopie une fois les onglets Creneaux, Jours, Semaines, Utilisateurs et Config
+# du classeur dans la table `reference` (sql/reference.sql à exécuter avant) :
+#
+#     python outils/migrer_reference.py [--secrets .streamlit/secrets.toml] [--departement mp] [--essai]
+#
+# Les identifiants sont ceux de l'application (SUPABASE_URL, SUPABASE_KEY,
+# gcp_service_account) ; le classeur et le schéma Supabase sont ceux du département
+# ([departements.<code>] dans secrets.toml, par défaut le classeur historique et
+# le schéma public). Relançable : chaque onglet est remplacé en entier puis
+# relu pour vérification. L'application lit ensuite Supabase ; le classeur ne sert
+# plus qu'en repli (bouton « Recharger les données de référence » en mode admin
+# pour basculer une instance déjà démarrée).
+import argparse
+import sys
+import tomllib
+from datetime import datetime, timezone
+from pathlib import Path
+
+RACINE = Path(__file__).resolve().parent.parent
+
+# Mêmes valeurs que NOM_SHEET et ONGLETS_REFERENCE dans Streamlit.py
+NOM_SHEET = "Indisponibilites-enseignants-configs"
+ONGLETS = ["Creneaux", "Jours", "Semaines", "Utilisateurs", "Config"]
+
+
+def completer_lignes(rows):
+    # L'API renvoie des lignes sans les cellules vides finales : on les complète
+    largeur = max((len(r) for r in rows), default=0)
+    return [r + [""] * (largeur - len(r)) for r in rows]
+
+
+def departement(secrets, code):
+    # Même lecture que departements() dans Streamlit.py
+    declares = {c.lower(): d for c, d in (secrets.get("departements") or {"geii": {}}).items()}
+    code = (code or secrets.get("DEPARTEMENT_DEFAUT") or next(iter(declares))).lower()
+    if code not in declares:
+        sys.exit(f"Département inconnu : {code} (déclarés : {', '.join(declares)})")
+    d = declares[code]
+    return {"code": code, "classeur": d.get("classeur", NOM_SHEET), "schema": d.get("schema", "public")}
+
+
+def ouvrir_classeur(secrets, nom):
+    import gspread
+    from google.oauth2.service_account import Credentials
+
+    creds = Credentials.from_service_account_info(
+        secrets["gcp_service_account"],
+        scopes=["https://www.googleapis.com/auth/spreadsheets.readonly"]
+    )
+    return gspread.authorize(creds).open(nom)
+
+
+def client_supabase(secrets, schema):
+    from supabase import create_client
+    client = create_client(secrets["SUPABASE_URL"], secrets["SUPABASE_KEY"])
+    return client if schema == "public" else client.schema(schema)
+
+
+def lire_onglets(classeur):
+    # 1 seul appel à l'API Sheets pour tous les onglets
+    reponse = classeur.values_batch_get([f"'{o}'" for o in ONGLETS])
+    return {onglet: completer_lignes(vr.get("values", [])) for onglet, vr in zip(ONGLETS, reponse["valueRanges"])}
+
+
+def migrer(classeur, client, essai=False):
+    onglets = lire_onglets(classeur)
+    for onglet, lignes in onglets.items():
+        print(f"{onglet:<14}{len(lignes):>6} lignes")
+    if essai:
+        return True
+
+    maintenant = datetime.now(timezone.utc).isoformat()
+    client.table("reference").upsert(
+        [{"onglet": onglet, "lignes": lignes, "modifie_le": maintenant} for onglet, lignes in onglets.items()],
+        on_conflict="onglet"
+    ).execute()
+
+    relues = {
+        l["onglet"]: l["lignes"]
+        for l in client.table("reference").select("onglet,lignes").in_("onglet", ONGLETS).execute().data
+    }
+    differences = [o for o in ONGLETS if relues.get(o) != onglets[o]]
+    for onglet in differences:
+        print(f"❌ {onglet} : contenu relu différent de la feuille", file=sys.stderr)
+    if not differences:
+        print("✅ Onglets recopiés dans la table reference")
+    return not differences
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Recopie les données de référence Google Sheets dans Supabase")
+    parser.add_argument("--secrets", type=Path, default=RACINE / ".streamlit" / "secrets.toml")
+    parser.add_argument("--departement", help="code du département (par défaut DEPARTEMENT_DEFAUT ou le premier)")
+    parser.add_argument("--essai", action="store_true", help="lire et afficher les onglets sans rien écrire")
+    args = parser.parse_args()
+
+    with open(args.secrets, "rb") as f:
+        secrets = tomllib.load(f)
+    cible = departement(secrets, args.departement)
+    print(f"Département {cible['code']} : classeur « {cible['classeur']} » -> schéma {cible['schema']}")
+    client = None if args.essai else client_supabase(secrets, cible["schema"])
+    sys.exit(0 if migrer(ouvrir_classeur(secrets, cible["classeur"]), client, args.essai) else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+-- Applique en une seule transaction le delta calculé par l'application
+-- (Streamlit.py, synchroniser_indisponibilites) :
+--   p_suppressions  : ids des lignes datas à supprimer
+--   p_ajouts        : nouvelles lignes (même format que l'insert)
+--   p_modifications : lignes existantes (avec id) dont la raison a changé
+--   p_commentaire   : nouveau commentaire global, ou null s'il est inchangé
+--   p_campagne_id   : campagne active (null sans campagne) ; les suppressions et
+--                     le commentaire ne portent que sur ses lignes
+-- Si la fonction n'est pas installée, l'application envoie le delta par lots
+-- (non atomique).
+--
+-- Sans sql/campagnes.sql (colonne datas.campagne_id absente), la campagne est
+-- ignorée, comme dans remplacer_indisponibilites.sql.
+
+drop function if exists appliquer_diff_indisponibilites(datas.enseignant_id%type, jsonb, jsonb, jsonb, text);
+
+create or replace function appliquer_diff_indisponibilites(
+    p_enseignant_id datas.enseignant_id%type,
+    p_suppressions jsonb,
+    p_ajouts jsonb,
+    p_modifications jsonb,
+    p_commentaire text default null,
+    p_campagne_id bigint default null
+)
+returns void
+language plpgsql
+as $$
+begin
+    update datas d
+    set raisons = m.raisons,
+        "timestamp" = now()
+    from jsonb_populate_recordset(null::datas, p_modifications) as m
+    where d.id = m.id
+      and d.enseignant_id = p_enseignant_id;
+
+    if not exists (
+        select 1 from pg_attribute
+        where attrelid = 'datas'::regclass and attname = 'campagne_id' and not attisdropped
+    ) then
+        delete from datas
+        where enseignant_id = p_enseignant_id
+          and id::text in (select jsonb_array_elements_text(p_suppressions));
+
+        insert into datas (enseignant_id, semaine, jour, creneau, code_creneau,
+                           code_streamlit, raisons, commentaires_global)
+        select p_enseignant_id, l.semaine, l.jour, l.creneau, l.code_creneau,
+               l.code_streamlit, l.raisons, l.commentaires_global
+        from jsonb_populate_recordset(null::datas, p_ajouts) as l;
+
+        if p_commentaire is not null then
+            update datas
+            set commentaires_global = p_commentaire,
+                "timestamp" = now()
+            where enseignant_id = p_enseignant_id;
+        end if;
+        return;
+    end if;
+
+    delete from datas
+    where enseignant_id = p_enseignant_id
+      and campagne_id is not distinct from p_campagne_id
+      and id::text in (select jsonb_array_elements_text(p_suppressions));
+
+    insert into datas (enseignant_id, semaine, jour, creneau, code_creneau,
+                       code_streamlit, raisons, commentaires_global, campagne_id)
+    select p_enseignant_id, l.semaine, l.jour, l.creneau, l.code_creneau,
+           l.code_streamlit, l.raisons, l.commentaires_global, p_campagne_id
+    from jsonb_populate_recordset(null::datas, p_ajouts) as l;
+
+    if p_commentaire is not null then
+        update datas
+        set commentaires_global = p_commentaire,
+            "timestamp" = now()
+        where enseignant_id = p_enseignant_id
+          and campagne_id is not distinct from p_campagne_id;
+    end if;
+end;
+$$;
@@ -0,0 +1,68 @@
+-- Campagnes de saisie (ex. "2026 S1 impairs"), liées au filtre semestre de
+-- l'onglet Config. Seule la campagne active reste dans datas / regles ; à sa
+-- clôture (mode administrateur), ses lignes sont déplacées par lots dans
+-- datas_archive / regles_archive, utilisées pour comparer les campagnes.
+-- À exécuter après regles.sql. Réexécuter aussi remplacer_indisponibilites.sql et
+-- appliquer_diff_indisponibilites.sql si la base a encore leur ancienne version
+-- (sans p_campagne_id) ; la version à jour fonctionne avec ou sans ce fichier.
+
+create table if not exists campagnes (
+    id bigint generated by default as identity primary key,
+    nom text not null unique,
+    semestre_filter text not null default 'Toutes',
+    statut text not null default 'active'
+        check (statut in ('active', 'archivee')),
+    creee_le timestamptz not null default now(),
+    archivee_le timestamptz
+);
+
+-- Une seule campagne active à la fois
+create unique index if not exists campagnes_active_idx on campagnes (statut) where statut = 'active';
+
+alter table datas add column if not exists campagne_id bigint references campagnes (id);
+alter table regles add column if not exists campagne_id bigint references campagnes (id);
+
+create index if not exists datas_campagne_enseignant_idx on datas (campagne_id, enseignant_id);
+create index if not exists regles_campagne_enseignant_idx on regles (campagne_id, enseignant_id);
+
+create table if not exists datas_archive (like datas including all);
+create table if not exists regles_archive (like regles including all);
+
+create index if not exists datas_archive_campagne_idx on datas_archive (campagne_id);
+create index if not exists regles_archive_campagne_idx on regles_archive (campagne_id);
+
+-- Déplace au plus p_taille lignes d'une campagne vers <p_table>_archive, dans une
+-- transaction ; renvoie le nombre de lignes supprimées de <p_table> (0 : campagne
+-- archivée). Ce sont les suppressions qui sont comptées, pas les insertions : après
+-- une clôture interrompue, un lot déjà copié dans l'archive (repli de
+-- l'application) est supprimé sans être réinséré, et ne doit pas arrêter la clôture.
+create or replace function archiver_lot(
+    p_table text,
+    p_campagne_id bigint,
+    p_taille integer default 5000
+)
+returns integer
+language plpgsql
+as $$
+declare
+    n integer;
+begin
+    if p_table not in ('datas', 'regles') then
+        raise exception 'table non archivable : %', p_table;
+    end if;
+
+    execute format(
+        'with lot as (
+             delete from %1$I
+             where id in (select id from %1$I where campagne_id = $1 order by id limit $2)
+             returning *
+         ), copie as (
+             insert into %2$I select * from lot on conflict (id) do nothing
+         )
+         select count(*) from lot',
+        p_table, p_table || '_archive'
+    ) into n using p_campagne_id, p_taille;
+
+    return n;
+end;
+$$;
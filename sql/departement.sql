@@ -0,0 +1,24 @@
+-- Nouveau département hébergé par la même application : un schéma Supabase
+-- isolé, avec les mêmes tables que public. Remplacer mp par le schéma déclaré
+-- dans secrets.toml ([departements.<code>] schema = "mp"), puis :
+--   1. exécuter ce fichier ;
+--   2. exécuter les autres fichiers de sql/ précédés de `set search_path to mp;` ;
+--   3. ajouter mp aux « Exposed schemas » (Settings > API) de Supabase ;
+--   4. remplir mp.enseignants et lancer outils/migrer_reference.py --departement <code>.
+
+create schema if not exists mp;
+grant usage on schema mp to anon, authenticated, service_role;
+
+create table if not exists mp.enseignants (like public.enseignants including all);
+create table if not exists mp.datas (like public.datas including all);
+
+-- Clé étrangère nécessaire à l'anti-jointure enseignants -> datas (relances)
+alter table mp.datas drop constraint if exists datas_enseignant_id_fkey;
+alter table mp.datas add constraint datas_enseignant_id_fkey
+    foreign key (enseignant_id) references mp.enseignants (id) on delete cascade;
+
+grant all on all tables in schema mp to anon, authenticated, service_role;
+grant all on all sequences in schema mp to anon, authenticated, service_role;
+alter default privileges in schema mp grant all on tables to anon, authenticated, service_role;
+alter default privileges in schema mp grant all on sequences to anon, authenticated, service_role;
+alter default privileges in schema mp grant execute on functions to anon, authenticated, service_role;
@@ -0,0 +1,18 @@
+-- Boîte d'envoi des emails (récapitulatifs, rappels) : une ligne par appel Brevo.
+-- Écrite par le thread d'envoi de Streamlit.py avant le premier essai (statut
+-- en_attente, repris au redémarrage) puis à chaque essai ; consultée en mode
+-- administrateur.
+
+create table if not exists emails (
+    id bigint generated by default as identity primary key,
+    cree_le timestamptz not null default now(),
+    destinataire text not null,
+    sujet text,
+    message jsonb not null,          -- arguments de SendSmtpEmail
+    statut text not null default 'en_attente'
+        check (statut in ('en_attente', 'envoye', 'echec')),
+    tentatives integer not null default 0,
+    erreur text
+);
+
+create index if not exists emails_statut_idx on emails (statut) where statut = 'en_attente';
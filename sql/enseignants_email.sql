@@ -0,0 +1,3 @@
+-- Adresse email des enseignants, utilisée pour les relances (mode administrateur).
+
+alter table enseignants add column if not exists email text;
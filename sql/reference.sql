@@ -0,0 +1,32 @@
+-- Données de référence (onglets Creneaux, Jours, Semaines, Utilisateurs et Config
+-- du classeur Google Sheets), recopiées par outils/migrer_reference.py. Chaque
+-- onglet est conservé tel quel : ses lignes, en-tête compris, dans `lignes`.
+-- Sans cette table (ou vide), Streamlit.py lit le classeur Google Sheets.
+
+create table if not exists reference (
+    onglet text primary key,
+    lignes jsonb not null default '[]',      -- [[cellule, ...], ...]
+    modifie_le timestamptz not null default now()
+);
+
+-- Tous les onglets en un appel, avec une version (md5 du contenu). Si p_version
+-- est la version courante, seule la version est renvoyée : la revalidation du
+-- cache de l'application ne transfère alors aucune ligne.
+create or replace function lire_reference(p_version text default null)
+returns jsonb
+language sql
+stable
+as $$
+    with v as (
+        select md5(coalesce(string_agg(onglet || ':' || md5(lignes::text), ',' order by onglet), '')) as version
+        from reference
+    )
+    select case
+        when v.version = p_version then jsonb_build_object('version', v.version)
+        else jsonb_build_object(
+            'version', v.version,
+            'onglets', (select coalesce(jsonb_object_agg(onglet, lignes), '{}'::jsonb) from reference)
+        )
+    end
+    from v;
+$$;
@@ -0,0 +1,18 @@
+-- Règles récurrentes : un produit semaines x jours x créneaux, une raison et des
+-- exceptions, au lieu d'une ligne datas par créneau. Développées par
+-- Streamlit.py (section RÈGLES RÉCURRENTES) pour l'export, la carte de chaleur,
+-- les créneaux libres et l'email. Sans cette table, les règles sont enregistrées
+-- développées dans datas.
+
+create table if not exists regles (
+    id bigint generated by default as identity primary key,
+    enseignant_id bigint not null references enseignants (id) on delete cascade,
+    semaines jsonb not null default '[]',    -- codes de l'onglet Semaines
+    jours jsonb not null default '[]',       -- codes de l'onglet Jours
+    creneaux jsonb not null default '[]',    -- codes de l'onglet Creneaux
+    raison text not null default '',
+    exceptions jsonb not null default '[]',  -- [[semaine, jour, creneau], ...] retirés
+    "timestamp" timestamptz not null default now()
+);
+
+create index if not exists regles_enseignant_id_idx on regles (enseignant_id);
@@ -0,0 +1,47 @@
+-- Remplace toutes les indisponibilités d'un enseignant en une seule transaction.
+-- Appelée par Streamlit.py (enregistrer_indisponibilites) via supabase.rpc(...).
+-- Si la fonction n'est pas installée, l'application se replie sur
+-- suppression + insertion par lots (non atomique).
+--
+-- p_campagne_id : campagne active (null sans campagne). Seules les lignes de
+-- cette campagne sont remplacées, comme dans le repli de l'application. Sans
+-- sql/campagnes.sql (colonne datas.campagne_id absente), toutes les lignes de
+-- l'enseignant sont remplacées : les requêtes PL/pgSQL n'étant analysées qu'à
+-- leur exécution, la branche campagne n'est jamais préparée sans la colonne.
+
+drop function if exists remplacer_indisponibilites(datas.enseignant_id%type, jsonb);
+
+create or replace function remplacer_indisponibilites(
+    p_enseignant_id datas.enseignant_id%type,
+    p_lignes jsonb,
+    p_campagne_id bigint default null
+)
+returns void
+language plpgsql
+as $$
+begin
+    if not exists (
+        select 1 from pg_attribute
+        where attrelid = 'datas'::regclass and attname = 'campagne_id' and not attisdropped
+    ) then
+        delete from datas where enseignant_id = p_enseignant_id;
+
+        insert into datas (enseignant_id, semaine, jour, creneau, code_creneau,
+                           code_streamlit, raisons, commentaires_global)
+        select p_enseignant_id, l.semaine, l.jour, l.creneau, l.code_creneau,
+               l.code_streamlit, l.raisons, l.commentaires_global
+        from jsonb_populate_recordset(null::datas, p_lignes) as l;
+        return;
+    end if;
+
+    delete from datas
+    where enseignant_id = p_enseignant_id
+      and campagne_id is not distinct from p_campagne_id;
+
+    insert into datas (enseignant_id, semaine, jour, creneau, code_creneau,
+                       code_streamlit, raisons, commentaires_global, campagne_id)
+    select p_enseignant_id, l.semaine, l.jour, l.creneau, l.code_creneau,
+           l.code_streamlit, l.raisons, l.commentaires_global, p_campagne_id
+    from jsonb_populate_recordset(null::datas, p_lignes) as l;
+end;
+$$;